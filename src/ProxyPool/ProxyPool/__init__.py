@@ -1,6 +1,9 @@
-import asyncio, time, logging
+import asyncio, time, logging, socket, os
 
-from .storage import ProxyPoolStorage
+from prometheus_client import start_http_server
+
+from .storage import AsyncProxyPoolStorage
+from .metrics import POOL_SIZE
 from .jobfactory import CrawlJobFactory, ValidateJobFactory
 from .network import NetManager
 # 综合调度 网络模块 工厂模块
@@ -10,35 +13,115 @@ class ProxyPool:
         self,
         *,
         crawl_job_interval_hour = 24, # 代理抓取任务间隔时间 小时
-        validate_job_interval_minute = 5, # 代理池验证任务间隔时间 分钟
+        validate_job_interval_minute = 5, # 汇总输出验证统计的间隔时间 分钟
+        validate_poll_interval_second = 1, # 没有到期代理时 再次检查的间隔时间 秒
         timeout = 20, # 请求超时时间
+        connect_timeout = 5, # 建立连接的超时时间
+        read_timeout = 10, # 读取响应的超时时间
         max_retry_count = 10, # CrawlJob 最多尝试次数
+        crawl_retry_base_delay = 1, # CrawlJob 第一次重试前等待的时间 秒 之后每次重试加倍
+        crawl_retry_max_delay = 60, # CrawlJob 重试前等待时间的上限 秒
         max_concurrent_request = 500, # 最大并发请求数量
+        crawl_worker_count = 20, # 抓取协程数量
+        validate_worker_count = 200, # 验证协程数量
+        validate_queue_size = 1000, # 验证任务队列长度
+        fast_validate_worker_count = 20, # 快速验证协程数量
+        fast_validate_queue_size = 5000, # 快速验证任务队列长度
+        validate_targets = None, # 验证请求的目标地址列表 默认为 https://httpbin.org/ip
+        crawl_connector_limit = 100, # 抓取连接池的连接总数上限 0 表示不限制
+        crawl_connector_limit_per_host = 10, # 抓取连接池中每个目标的连接数上限
+        crawl_keepalive_timeout = 30, # 抓取连接空闲保持时间 秒
+        validate_connector_limit = 0, # 验证连接池的连接总数上限 0 表示不限制
+        validate_connector_limit_per_host = 0, # 验证连接池中每个目标的连接数上限
+        validate_keepalive_timeout = 0, # 验证连接空闲保持时间 秒 0 表示不保持
+        dns_cache_ttl = 300, # DNS 缓存时间 秒
+        metrics_port = 0, # Prometheus 指标的 HTTP 端口 0 表示不启动
+        metrics_interval_second = 15, # 更新代理池数量指标的间隔时间 秒
+        role = "standalone", # standalone 单进程运行 coordinator 抓取并将到期代理写入验证 Stream validator 只验证 Stream 中的代理
+        consumer_name = None, # validator 在消费者组中的名称 默认为 主机名-进程号
+        validate_stream_max_length = 5000, # coordinator 保持验证 Stream 中积压的代理不超过此数量
+        validate_stream_reclaim_idle_second = 300, # validator 接管其他 validator 超过此时间未确认的代理 秒 应小于 claim_timeout
+        shard_count = 0, # coordinator 按代理键的哈希 将到期代理写入的分片数量 0 表示写入共用的验证 Stream
+        shard = None, # validator 只验证此分片的代理 None 表示读取共用的验证 Stream
         **kwargs # 剩下参数全为 抓取任务的配置参数
     ):
-        self.storage = ProxyPoolStorage()
+        self.storage = AsyncProxyPoolStorage()
         self.crawl_job_factory = CrawlJobFactory(
             **kwargs
         )
-        self.validate_job_factory = ValidateJobFactory()
+        self.validate_job_factory = ValidateJobFactory(shard=shard, shard_count=shard_count)
         self.net_manager = NetManager(
             timeout=timeout,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
             max_retry_count=max_retry_count,
-            max_concurrent_request=max_concurrent_request
+            crawl_retry_base_delay=crawl_retry_base_delay,
+            crawl_retry_max_delay=crawl_retry_max_delay,
+            max_concurrent_request=max_concurrent_request,
+            crawl_worker_count=crawl_worker_count,
+            validate_worker_count=validate_worker_count,
+            validate_queue_size=validate_queue_size,
+            fast_validate_worker_count=fast_validate_worker_count,
+            fast_validate_queue_size=fast_validate_queue_size,
+            validate_targets=validate_targets,
+            crawl_connector_limit=crawl_connector_limit,
+            crawl_connector_limit_per_host=crawl_connector_limit_per_host,
+            crawl_keepalive_timeout=crawl_keepalive_timeout,
+            validate_connector_limit=validate_connector_limit,
+            validate_connector_limit_per_host=validate_connector_limit_per_host,
+            validate_keepalive_timeout=validate_keepalive_timeout,
+            dns_cache_ttl=dns_cache_ttl
         )
+        # 新抓取的代理立即进入快速验证队列 不必等待下一轮验证
+        # 进入队列的代理在取出超时后才到期 快速验证写入结果时会重新设置下一次验证时间 不会被到期验证重复验证
+        self.crawl_job_factory.on_proxies_added = self.enqueue_fast_validate_jobs
+        self.crawl_job_factory.new_proxy_due_delay = self.validate_job_factory.claim_timeout
+        # 抓取源限速器由 CrawlJobFactory 声明 NetManager 执行
+        self.net_manager.crawl_source_limiters = self.crawl_job_factory.source_limiters
         self.crawl_job_interval = crawl_job_interval_hour * 3600
         self.validate_job_interval = validate_job_interval_minute * 60
+        self.validate_poll_interval = validate_poll_interval_second
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval_second
+        if role not in ("standalone", "coordinator", "validator"): raise ValueError("未知的 role {}".format(role))
+        self.role = role
+        self.consumer_name = consumer_name or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.validate_stream_max_length = validate_stream_max_length
+        self.validate_stream_reclaim_idle = validate_stream_reclaim_idle_second
+        self.shard_count = shard_count
+        self.shard = shard
 
         self.task_for_produce_crawl_validate_job: asyncio.Task = None
+        self.task_for_update_metrics: asyncio.Task = None
 
     # 启动 线程池 并行运行
     def detach_run(self):
         # 启动 netmanager 模块
         self.net_manager.run()
-        # 并发运行 两个 consumer 协程
-        self.task_for_produce_crawl_validate_job = asyncio.gather(
+        # validator 只消费验证 Stream 其余并发运行 两个 producer 协程
+        if self.role == "validator":
+            self.task_for_produce_crawl_validate_job = asyncio.ensure_future(self.stream_validate_consumer())
+        else:
+            self.task_for_produce_crawl_validate_job = asyncio.ensure_future(self.run_producers())
+        # 在独立线程中提供指标 并定期更新需要访问 Redis 的指标
+        if self.metrics_port > 0:
+            start_http_server(self.metrics_port)
+            self.task_for_update_metrics = asyncio.ensure_future(self.update_metrics())
+
+    # 迁移旧版本数据后 并发运行两个 producer 协程
+    async def run_producers(self):
+        count_of_migrated = await self.storage.migrate_legacy_members()
+        if count_of_migrated > 0:
+            logging.info("迁移旧版本代理 {} 个".format(count_of_migrated))
+        count_of_scheduled = await self.storage.schedule_unscheduled()
+        if count_of_scheduled > 0:
+            logging.info("为 {} 个代理设置下一次验证时间".format(count_of_scheduled))
+        count_of_indexed = await self.storage.build_attribute_indexes()
+        if count_of_indexed > 0:
+            logging.info("为 {} 个代理建立属性索引".format(count_of_indexed))
+        await asyncio.gather(
             self.crawljob_producer(), 
-            self.validatejob_producer()
+            self.stream_validatejob_producer() if self.role == "coordinator" else self.validatejob_producer()
         )
 
 
@@ -47,9 +130,9 @@ class ProxyPool:
         while True:
             start_time = time.time()
             self.net_manager.event_crawl_job_finish.clear()
-            for crawl_job in self.crawl_job_factory.get_jobs():
+            for crawl_job in await self.crawl_job_factory.get_jobs():
                 self.net_manager.append_job(crawl_job)
-            await self.net_manager.event_crawl_job_finish.wait()
+            await self.net_manager.wait_crawl_jobs_done()
             finish_time = time.time()
 
             logging.info("代理爬取完成 爬取 {} 个页面 添加代理 {} 个 爬取失败 {} 个 耗时 {}".format(
@@ -60,44 +143,188 @@ class ProxyPool:
             ))
             await asyncio.sleep(self.crawl_job_interval)
 
-    # validate job 生产协程 每隔一段时间 向网络模块中入队任务
+    # validate job 生产协程 持续取出到期的代理入队验证 每隔一段时间输出验证统计
+    # 稳定的代理验证间隔逐渐变长 失败的代理很快再次验证
     async def validatejob_producer(self):
+        start_time = time.time()
+        self.net_manager.event_validate_job_finish.clear()
         while True:
-            start_time = time.time()
-            self.net_manager.event_validate_job_finish.clear()
-            for validate_job in self.validate_job_factory.get_jobs():
-                self.net_manager.append_job(validate_job)
-            await self.net_manager.event_validate_job_finish.wait()
+            validate_job_list = await self.validate_job_factory.claim_due_jobs()
+            # 队列满时等待验证协程消费
+            for validate_job in validate_job_list:
+                await self.net_manager.put_job(validate_job)
+            if len(validate_job_list) == 0:
+                # 暂无到期代理 写入缓存的验证结果
+                await self.validate_job_factory.flush_validate_results()
+                await asyncio.sleep(self.validate_poll_interval)
+
             finish_time = time.time()
+            if finish_time - start_time >= self.validate_job_interval:
+                logging.info("代理池验证统计 验证 {} 个代理 有效激活代理 {} 个 耗时 {}".format(
+                    self.net_manager.event_validate_job_finish.count_of_total_proxy,
+                    self.net_manager.event_validate_job_finish.count_of_activated_proxy,
+                    finish_time - start_time
+                ))
+                start_time = finish_time
+                self.net_manager.event_validate_job_finish.clear()
 
-            logging.info("代理池验证完成 验证 {} 个代理 有效激活代理 {} 个 耗时 {}".format(
-                self.net_manager.event_validate_job_finish.count_of_total_proxy,
-                self.net_manager.event_validate_job_finish.count_of_activated_proxy,
-                finish_time - start_time
-            ))
-            await asyncio.sleep(self.validate_job_interval)
+    # coordinator 写入的验证 Stream 分片 不分片时为 [None] 即共用的 Stream
+    @property
+    def stream_shards(self) -> list:
+        return list(range(self.shard_count)) if self.shard_count > 0 else [None]
+
+    # coordinator 的 validate job 生产协程 验证 Stream 中积压的代理不足 validate_stream_max_length 时 取出到期代理写入
+    # 每隔一段时间输出全部 validator 的验证统计 统计只计入确认成功的验证结果 因此不会因 validator 退出或重复验证而出错
+    async def stream_validatejob_producer(self):
+        for shard in self.stream_shards:
+            await self.storage.ensure_validate_group(shard)
+            await self.storage.pop_validate_stats(shard)
+        start_time = time.time()
+        while True:
+            count_of_enqueued = 0
+            backlog = 0
+            for shard in self.stream_shards:
+                backlog += await self.storage.validate_backlog(shard)
+            if backlog < self.validate_stream_max_length:
+                count_of_enqueued = await self.validate_job_factory.enqueue_due_to_stream(self.validate_stream_max_length - backlog)
+            if count_of_enqueued == 0:
+                await asyncio.sleep(self.validate_poll_interval)
+
+            finish_time = time.time()
+            if finish_time - start_time >= self.validate_job_interval:
+                shard_stats = [ await self.storage.pop_validate_stats(shard) for shard in self.stream_shards ]
+                logging.info("代理池验证统计 验证 {} 个代理 有效激活代理 {} 个 耗时 {} 积压 {}{}".format(
+                    sum(total for total, _ in shard_stats), sum(activated for _, activated in shard_stats), finish_time - start_time, backlog,
+                    "" if self.shard_count == 0 else " 各分片 验证/激活 " + " ".join( "{}/{}".format(*stats) for stats in shard_stats )
+                ))
+                start_time = finish_time
+
+    # validator 的消费协程 按验证队列的空闲长度读取验证 Stream 中的代理 并定期接管其他 validator 未确认的代理
+    async def stream_validate_consumer(self):
+        await self.storage.ensure_validate_group(self.shard)
+        validate_job_queue = self.net_manager.validate_job_queue
+        reclaimed_at = 0.0
+        while True:
+            if validate_job_queue.maxsize > 0: count = validate_job_queue.maxsize - validate_job_queue.qsize()
+            else: count = self.validate_job_factory.claim_batch_size
+            validate_job_list = list()
+            if count > 0 and time.time() - reclaimed_at >= self.validate_stream_reclaim_idle / 2:
+                validate_job_list = await self.validate_job_factory.reclaim_stream_jobs(
+                    self.consumer_name, self.validate_stream_reclaim_idle, count
+                )
+                reclaimed_at = time.time()
+                if len(validate_job_list) > 0:
+                    logging.warning("接管其他 validator 未确认的代理 {} 个".format(len(validate_job_list)))
+            if count - len(validate_job_list) > 0:
+                validate_job_list += await self.validate_job_factory.read_stream_jobs(self.consumer_name, count - len(validate_job_list))
+            for validate_job in validate_job_list:
+                await self.net_manager.put_job(validate_job)
+            if len(validate_job_list) == 0:
+                # 暂无代理 确认缓存的验证结果
+                await self.validate_job_factory.flush_stream_validate_results()
+                await asyncio.sleep(self.validate_poll_interval)
+
+    # 定期统计各分数区间的代理数量
+    async def update_metrics(self):
+        while True:
+            try:
+                for band, count in (await self.storage.count_by_score_band()).items():
+                    POOL_SIZE.labels(band).set(count)
+            except Exception as e:
+                logging.error("更新代理池指标异常: %s" % e)
+            await asyncio.sleep(self.metrics_interval)
+
+    # 将新抓取的代理加入快速验证队列 队列已满的代理设置为立即到期 由到期验证处理
+    async def enqueue_fast_validate_jobs(self, proxy_list):
+        dropped_proxy_list = list()
+        for validate_job in self.validate_job_factory.make_fast_validate_jobs(proxy_list):
+            if not self.net_manager.append_fast_validate_job(validate_job): dropped_proxy_list.append(validate_job.proxy_item)
+        if len(dropped_proxy_list) > 0:
+            await self.storage.schedule_now(dropped_proxy_list)
+            logging.warning("快速验证队列已满 {} 个新代理由到期验证处理".format(len(dropped_proxy_list)))
 
     # 从代理池中获取代理
-    def get(self):
-        return self.storage.get()
+    # strategy 为 random 时从前三十中随机选择 为 weighted 时以延迟的倒数为权重随机选择 为 fastest 时返回延迟最低的代理
+    async def get(self, strategy: str = "random"):
+        if strategy == "weighted": return await self.storage.get_weighted_random()
+        elif strategy == "fastest":
+            proxy_list = await self.storage.get_fastest(1)
+            return proxy_list[0] if len(proxy_list) > 0 else None
+        else: return await self.storage.get()
+
+    # 获取延迟最低的 count 个代理
+    async def get_fastest(self, count: int = 10):
+        return await self.storage.get_fastest(count)
 
 
 # 返回 经过初始化的 ProxyPool 实例
 def create_proxypool(
     *,
     crawl_job_interval_hour = 24, # 代理抓取任务间隔时间 小时
-    validate_job_interval_minute = 5, # 代理池验证任务间隔时间 分钟
+    validate_job_interval_minute = 5, # 汇总输出验证统计的间隔时间 分钟
+    validate_poll_interval_second = 1, # 没有到期代理时 再次检查的间隔时间 秒
     timeout = 20, # 请求超时时间
+    connect_timeout = 5, # 建立连接的超时时间
+    read_timeout = 10, # 读取响应的超时时间
     max_retry_count = 10, # CrawlJob 最多尝试次数
+    crawl_retry_base_delay = 1, # CrawlJob 第一次重试前等待的时间 秒 之后每次重试加倍
+    crawl_retry_max_delay = 60, # CrawlJob 重试前等待时间的上限 秒
     max_concurrent_request = 500, # 最大并发请求数量
+    crawl_worker_count = 20, # 抓取协程数量
+    validate_worker_count = 200, # 验证协程数量
+    validate_queue_size = 1000, # 验证任务队列长度
+    fast_validate_worker_count = 20, # 快速验证协程数量
+    fast_validate_queue_size = 5000, # 快速验证任务队列长度
+    validate_targets = None, # 验证请求的目标地址列表 默认为 https://httpbin.org/ip
+    crawl_connector_limit = 100, # 抓取连接池的连接总数上限 0 表示不限制
+    crawl_connector_limit_per_host = 10, # 抓取连接池中每个目标的连接数上限
+    crawl_keepalive_timeout = 30, # 抓取连接空闲保持时间 秒
+    validate_connector_limit = 0, # 验证连接池的连接总数上限 0 表示不限制
+    validate_connector_limit_per_host = 0, # 验证连接池中每个目标的连接数上限
+    validate_keepalive_timeout = 0, # 验证连接空闲保持时间 秒 0 表示不保持
+    dns_cache_ttl = 300, # DNS 缓存时间 秒
+    metrics_port = 0, # Prometheus 指标的 HTTP 端口 0 表示不启动
+    metrics_interval_second = 15, # 更新代理池数量指标的间隔时间 秒
+    role = "standalone", # standalone 单进程运行 coordinator 抓取并将到期代理写入验证 Stream validator 只验证 Stream 中的代理
+    consumer_name = None, # validator 在消费者组中的名称 默认为 主机名-进程号
+    validate_stream_max_length = 5000, # coordinator 保持验证 Stream 中积压的代理不超过此数量
+    validate_stream_reclaim_idle_second = 300, # validator 接管其他 validator 超过此时间未确认的代理 秒 应小于 claim_timeout
+    shard_count = 0, # coordinator 按代理键的哈希 将到期代理写入的分片数量 0 表示写入共用的验证 Stream
+    shard = None, # validator 只验证此分片的代理 None 表示读取共用的验证 Stream
     **kwargs, # 抓取任务配置参数 全部传递给 CrawlJobFactory
 ) -> ProxyPool:
     proxy_pool = ProxyPool(
         crawl_job_interval_hour=crawl_job_interval_hour,
         validate_job_interval_minute=validate_job_interval_minute,
+        validate_poll_interval_second=validate_poll_interval_second,
         timeout=timeout,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
         max_retry_count=max_retry_count,
+        crawl_retry_base_delay=crawl_retry_base_delay,
+        crawl_retry_max_delay=crawl_retry_max_delay,
         max_concurrent_request=max_concurrent_request,
+        crawl_worker_count=crawl_worker_count,
+        validate_worker_count=validate_worker_count,
+        validate_queue_size=validate_queue_size,
+        fast_validate_worker_count=fast_validate_worker_count,
+        fast_validate_queue_size=fast_validate_queue_size,
+        validate_targets=validate_targets,
+        crawl_connector_limit=crawl_connector_limit,
+        crawl_connector_limit_per_host=crawl_connector_limit_per_host,
+        crawl_keepalive_timeout=crawl_keepalive_timeout,
+        validate_connector_limit=validate_connector_limit,
+        validate_connector_limit_per_host=validate_connector_limit_per_host,
+        validate_keepalive_timeout=validate_keepalive_timeout,
+        dns_cache_ttl=dns_cache_ttl,
+        metrics_port=metrics_port,
+        metrics_interval_second=metrics_interval_second,
+        role=role,
+        consumer_name=consumer_name,
+        validate_stream_max_length=validate_stream_max_length,
+        validate_stream_reclaim_idle_second=validate_stream_reclaim_idle_second,
+        shard_count=shard_count,
+        shard=shard,
         **kwargs
     )
     proxy_pool.detach_run()
@@ -0,0 +1,27 @@
+'''
+以离线 GeoIP 数据库查询代理 ip 所属的国家 不访问网络
+数据库为 MaxMind mmdb 格式 例如 GeoLite2-Country.mmdb 或 GeoLite2-City.mmdb 读取需要安装 maxminddb
+未配置数据库时不使用此模块 代理的国家为空字符串
+'''
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+
+class GeoIPDatabase:
+    def __init__(self, database_path: str):
+        if maxminddb is None:
+            raise RuntimeError("配置了 GeoIP 数据库 {} 但没有安装 maxminddb".format(database_path))
+        # MODE_AUTO 在安装了 libmaxminddb 时使用 C 扩展 否则使用纯 Python 实现 查询均在内存映射的文件中完成
+        self.reader = maxminddb.open_database(database_path)
+
+    # 国家的 ISO 3166 代码 数据库中没有此 ip 或 ip 格式错误时返回空字符串
+    def country(self, ip: str) -> str:
+        try:
+            record = self.reader.get(ip)
+        except ValueError:
+            return ""
+        if not record: return ""
+        country = record.get("country") or record.get("registered_country") or dict()
+        return country.get("iso_code", "")
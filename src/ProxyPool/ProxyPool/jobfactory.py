@@ -1,10 +1,13 @@
-from typing import List, Callable
-import json, logging, configparser, re, base64, time, traceback
+from typing import List, Callable, Awaitable, Tuple, Set, Optional, Dict
+from concurrent.futures import ProcessPoolExecutor
+import json, configparser, time, inspect, asyncio, functools
 
-from bs4 import BeautifulSoup
-
-from .storage import ProxyPoolStorage
-from .models import JobBase, CrawlJob, ValidateJob, ProxyItem
+from .storage import AsyncProxyPoolStorage
+from .models import JobBase, CrawlJob, ValidateJob, ProxyItem, FetchResult
+from .geoip import GeoIPDatabase
+from .parser import ProxyRow, parse_page
+from .ratelimit import SourceLimiter, crawl_source
+from .metrics import PARSE_LATENCY
 
 # JobFactory MetaClass
 class JobFactoryMetaClass(type):
@@ -17,10 +20,13 @@ class JobFactoryMetaClass(type):
 
 # JobFactory 基类
 class JobFactory(object, metaclass=JobFactoryMetaClass):
-    def get_jobs(self) -> List[JobBase]:
+    # produce_ 方法可以是普通函数 也可以是协程函数
+    async def get_jobs(self) -> List[JobBase]:
         job_list: List[JobBase] = list()
         for func in getattr(self, "__Produce_Func__"):
-            job_list.extend(func(self))
+            jobs = func(self)
+            if inspect.isawaitable(jobs): jobs = await jobs
+            job_list.extend(jobs)
         return job_list
 
 
@@ -28,43 +34,97 @@ class JobFactory(object, metaclass=JobFactoryMetaClass):
 # ValidateJob 工厂 
 class ValidateJobFactory(JobFactory):
 
-    def __init__(self):
-        self.storage = ProxyPoolStorage()
-
-    # 生产 ValidateJob
-    def produce_validate_jobs(self) -> List[ValidateJob]:
-        # job callback 
-        def validate_job_callback(html_content: str, proxy_item: ProxyItem) -> bool:
-            # 验证响应是否有效
-            is_valide = False
-            try:
-                if html_content != "":
-                    json_dict = json.loads(html_content)
-                    is_valide = json_dict.get("origin", "") == proxy_item.ip
-            except ValueError:
-                pass
-
-            # 通知 Storage
-            if is_valide: self.storage.activate(proxy_item)
-            else: self.storage.deactivate(proxy_item)
-            return is_valide
-        
-        validate_jobs: List[ValidateJob] = list()
-        for proxy in self.storage.get_all():
-            validate_jobs.append(ValidateJob(proxy_item=proxy, callback=validate_job_callback))
-        
-        # 没有任何代理存在 造成死锁 返回一个 FakeProxyValidateJob
-        if len(validate_jobs) == 0:
-            fake_validate_job = ValidateJob(
-                proxy_item=ProxyItem(
-                    ip="0.0.0.0",
-                    port="0",
-                    https=False
-                ), 
-                callback=validate_job_callback
-            )
-            return [fake_validate_job, ]
-        else: return validate_jobs
+    def __init__(
+        self,
+        *,
+        validate_result_batch_size = 100, # 验证结果攒够多少个后批量写入 Storage
+        claim_batch_size = 500, # 每次从 Storage 中取出到期代理的最大数量
+        claim_timeout = 600, # 取出的代理在多少秒内不会被再次取出 应大于任务排队与验证的耗时
+        shard = None, # 验证进程读取的验证 Stream 分片 None 为共用的 Stream
+        shard_count = 0, # 协调进程写入验证 Stream 的分片数量 0 表示写入共用的 Stream
+    ):
+        self.storage = AsyncProxyPoolStorage()
+        self.shard = shard
+        self.shard_count = shard_count
+        self.validate_result_batch_size = validate_result_batch_size
+        self.claim_batch_size = claim_batch_size
+        self.claim_timeout = claim_timeout
+        self.pending_validate_results: List[Tuple[ProxyItem, bool, FetchResult]] = list()
+        # 分布式验证 (消息 id, 代理, 是否可用, 验证请求的结果)
+        self.pending_stream_validate_results: List[Tuple[str, ProxyItem, bool, FetchResult]] = list()
+
+    # 将缓存的验证结果通过一个 pipeline 写入 Storage
+    async def flush_validate_results(self):
+        results, self.pending_validate_results = self.pending_validate_results, list()
+        await self.storage.apply_validate_results(results)
+
+    # 验证响应是否有效 响应中的 origin 应为代理的 ip
+    @staticmethod
+    def is_valid_response(fetch_result: FetchResult, proxy_item: ProxyItem) -> bool:
+        try:
+            if fetch_result.content != "":
+                json_dict = json.loads(fetch_result.content)
+                return json_dict.get("origin", "") == proxy_item.ip
+        except ValueError:
+            pass
+        return False
+
+    # 验证回调 验证响应是否有效 并缓存验证结果以及验证请求的耗时
+    async def validate_job_callback(self, fetch_result: FetchResult, proxy_item: ProxyItem) -> bool:
+        is_valide = self.is_valid_response(fetch_result, proxy_item)
+
+        # 缓存验证结果 批量通知 Storage
+        self.pending_validate_results.append((proxy_item, is_valide, fetch_result))
+        if len(self.pending_validate_results) >= self.validate_result_batch_size:
+            await self.flush_validate_results()
+        return is_valide
+
+    # 快速验证回调 新抓取的代理验证后立即写入 Storage 使可用代理尽快参与排序
+    async def fast_validate_job_callback(self, fetch_result: FetchResult, proxy_item: ProxyItem) -> bool:
+        is_valide = self.is_valid_response(fetch_result, proxy_item)
+        await self.storage.apply_validate_results([(proxy_item, is_valide, fetch_result)])
+        return is_valide
+
+    # 为新抓取的代理生成快速验证任务
+    def make_fast_validate_jobs(self, proxy_list: List[ProxyItem]) -> List[ValidateJob]:
+        return [ ValidateJob.construct(proxy_item=proxy, callback=self.fast_validate_job_callback) for proxy in proxy_list ]
+
+    # 为到期需要验证的代理生成 ValidateJob 验证间隔由 Storage 根据每个代理的验证历史决定
+    async def claim_due_jobs(self) -> List[ValidateJob]:
+        proxy_list = await self.storage.claim_due(self.claim_batch_size, self.claim_timeout)
+        return [ ValidateJob.construct(proxy_item=proxy, callback=self.validate_job_callback) for proxy in proxy_list ]
+
+    # 将缓存的分布式验证结果 确认并写入 Storage
+    async def flush_stream_validate_results(self):
+        results, self.pending_stream_validate_results = self.pending_stream_validate_results, list()
+        await self.storage.ack_validate_results(results, self.shard)
+
+    # 分布式验证回调 验证结果与消息 id 一起缓存 批量确认
+    async def stream_validate_job_callback(self, message_id: str, fetch_result: FetchResult, proxy_item: ProxyItem) -> bool:
+        is_valide = self.is_valid_response(fetch_result, proxy_item)
+        self.pending_stream_validate_results.append((message_id, proxy_item, is_valide, fetch_result))
+        if len(self.pending_stream_validate_results) >= self.validate_result_batch_size:
+            await self.flush_stream_validate_results()
+        return is_valide
+
+    def _make_stream_jobs(self, entry_list: List[Tuple[str, ProxyItem]]) -> List[ValidateJob]:
+        return [
+            ValidateJob.construct(proxy_item=proxy, callback=functools.partial(self.stream_validate_job_callback, message_id))
+            for message_id, proxy in entry_list
+        ]
+
+    # 协调进程 取出最多 count 个到期的代理写入验证 Stream 返回写入的数量
+    async def enqueue_due_to_stream(self, count: int) -> int:
+        proxy_list = await self.storage.claim_due(min(count, self.claim_batch_size), self.claim_timeout)
+        return await self.storage.enqueue_validate(proxy_list, self.shard_count)
+
+    # 验证进程 读取验证 Stream 中的代理 生成 ValidateJob
+    async def read_stream_jobs(self, consumer: str, count: int) -> List[ValidateJob]:
+        return self._make_stream_jobs(await self.storage.read_validate(consumer, count, self.shard))
+
+    # 验证进程 接管其他验证进程超过 min_idle_second 秒未确认的代理
+    async def reclaim_stream_jobs(self, consumer: str, min_idle_second: float, count: int) -> List[ValidateJob]:
+        return self._make_stream_jobs(await self.storage.reclaim_validate(consumer, int(min_idle_second * 1000), count, self.shard))
 
 
 # CrawlJob 工厂
@@ -74,105 +134,102 @@ class CrawlJobFactory(JobFactory):
         *,
         crawl_page_count_for_xici = 10, # 抓取的 XICIDAILI 的数量
         crawl_page_count_for_freeproxy = 10, # 抓取的 freeproxy 的数量
+        parse_process_count = 2, # 解析页面的进程数量
+        geoip_database = "", # 离线 GeoIP 数据库文件的路径 空字符串表示不查询代理所属的国家
+        **source_limit_options # 抓取源限速配置 rate_limit_for_<source> burst_for_<source> concurrency_for_<source>
     ):
-        self.storage = ProxyPoolStorage()
+        self.storage = AsyncProxyPoolStorage()
         self.page_count_for_xici = crawl_page_count_for_xici
         self.page_count_for_freeproxy = crawl_page_count_for_freeproxy
+        # html 解析为 CPU 密集任务 放到进程池中运行 避免阻塞事件循环
+        self.parse_executor = ProcessPoolExecutor(max_workers=parse_process_count)
+        self.geoip = GeoIPDatabase(geoip_database) if geoip_database else None
+        # 本轮抓取中已经出现过的代理键 多个页面或网站中重复出现的代理只写入一次
+        self.seen_proxy_keys: Set[str] = set()
+        # 新代理加入代理池后的回调协程函数 参数为新加入的代理列表 由 ProxyPool 设置
+        self.on_proxies_added: Optional[Callable[[List[ProxyItem]], Awaitable[None]]] = None
+        # 新代理在多少秒后到期验证 新代理由快速验证队列验证时 由 ProxyPool 设置为取出代理的超时时间 避免重复验证
+        self.new_proxy_due_delay = 0
+        # 抓取源名称 -> 限速器 默认值由 produce_ 方法的 crawl_source 装饰器声明 可以被配置覆盖
+        self.source_limiters: Dict[str, SourceLimiter] = self._create_source_limiters(source_limit_options)
+
+    # 根据 crawl_source 装饰器以及配置 为每个抓取源创建限速器
+    @classmethod
+    def _create_source_limiters(cls, source_limit_options: Dict[str, float]) -> Dict[str, SourceLimiter]:
+        limit_dict: Dict[str, dict] = dict()
+        for func in getattr(cls, "__Produce_Func__"):
+            if hasattr(func, "crawl_source"): limit_dict[func.crawl_source] = dict(func.crawl_source_limit)
+        for option_key, value in source_limit_options.items():
+            for name, prefix in (("rate", "rate_limit_for_"), ("burst", "burst_for_"), ("concurrency", "concurrency_for_")):
+                if option_key.startswith(prefix) and option_key[len(prefix):] in limit_dict:
+                    limit_dict[option_key[len(prefix):]][name] = value
+                    break
+            else:
+                raise ValueError("未知的抓取源限速配置 {}".format(option_key))
+        return { source: SourceLimiter(source, **limit) for source, limit in limit_dict.items() }
+
+    # 每轮抓取开始时清空已出现的代理
+    async def get_jobs(self) -> List[JobBase]:
+        self.seen_proxy_keys.clear()
+        return await super().get_jobs()
+
+    # 在进程池中使用 parser.register_parser 注册的解析函数解析页面 事件循环中只保留 Storage 的写入
+    async def parse_in_process(self, source: str, content: str) -> List[ProxyRow]:
+        with PARSE_LATENCY.labels(source).time():
+            return await asyncio.get_running_loop().run_in_executor(self.parse_executor, parse_page, source, content)
+
+    # 略过本轮已出现的代理 其余代理一次批量添加到 Storage 中 返回新添加的代理数量
+    # 透明代理的请求会带上真实 ip 无法通过验证 同样略过
+    async def add_proxy_rows(self, row_list: List[ProxyRow]) -> int:
+        proxy_dict: Dict[str, ProxyItem] = dict()
+        for ip, port, https, anonymity in row_list:
+            if anonymity == "transparent": continue
+            proxy = ProxyItem.construct(ip=ip, port=port, https=https, anonymity=anonymity, country="")
+            if proxy.key in self.seen_proxy_keys or proxy.key in proxy_dict: continue
+            if self.geoip is not None: proxy.country = self.geoip.country(ip)
+            proxy_dict[proxy.key] = proxy
+        added_proxy_list = await self.storage.add_many(list(proxy_dict.values()), self.new_proxy_due_delay)
+        # 写入成功后才记为已出现 写入失败时重试的任务仍会添加这些代理
+        self.seen_proxy_keys.update(proxy_dict.keys())
+        if self.on_proxies_added is not None and len(added_proxy_list) > 0:
+            await self.on_proxies_added(added_proxy_list)
+        return len(added_proxy_list)
     
     # 生产用户抓取 xicidaili 的 job
+    @crawl_source("xicidaili", rate=0.5, burst=2, concurrency=2)
     def produce_job_for_xicidaili(self) -> List[CrawlJob]:
         # job callback
-        def crawl_xici_job_callback(content: str):
-            count_of_added_proxy = 0
-            soup = BeautifulSoup(content, "lxml")
-            for tr_node in soup.select("#ip_list tr")[1:]:
-                td_node_list = tr_node.select("td")
-                proxy_item = ProxyItem(
-                    ip=td_node_list[1].string,
-                    port=td_node_list[2].string,
-                    https=td_node_list[5].string == "HTTPS"
-                )
-                is_added = self.storage.add(proxy_item)
-                count_of_added_proxy += int(is_added)
-            return count_of_added_proxy
+        async def crawl_xici_job_callback(content: str):
+            return await self.add_proxy_rows(await self.parse_in_process("xicidaili", content))
         
         crawl_job_list: List[CrawlJob] = list()
         url_template = "https://www.xicidaili.com/nn/{}"
         for index in range(self.page_count_for_xici):
             target_url = url_template.format(index + 1)
-            crawl_job_list.append(CrawlJob(target_url=target_url, callback=crawl_xici_job_callback))
+            crawl_job_list.append(CrawlJob(target_url=target_url, source="xicidaili", callback=crawl_xici_job_callback))
         return crawl_job_list
     
     # 为 free proxy list 生成抓取任务
     # https://free-proxy-list.net/
+    @crawl_source("free_proxy_list", rate=0.2, burst=1, concurrency=1)
     def produce_job_for_FreeProxyList(self) -> List[CrawlJob]:
         # callback
-        def crawl_FreeProxyList_callback(content: str):
-            count_of_added_proxy = 0
-            soup = BeautifulSoup(content, "lxml")
-            for tr_node in soup.select("#proxylisttable tbody>tr"):
-                td_node_list = tr_node.select("td")
-                proxy_item = ProxyItem(
-                    ip=td_node_list[0].string,
-                    port=td_node_list[1].string,
-                    https=td_node_list[6].string == "yes"
-                )
-                is_added = self.storage.add(proxy_item)
-                count_of_added_proxy += int(is_added)
-            return count_of_added_proxy
+        async def crawl_FreeProxyList_callback(content: str):
+            return await self.add_proxy_rows(await self.parse_in_process("free_proxy_list", content))
         target_url = "https://free-proxy-list.net/"
-        return [CrawlJob(target_url=target_url, callback=crawl_FreeProxyList_callback),]
+        return [CrawlJob(target_url=target_url, source="free_proxy_list", callback=crawl_FreeProxyList_callback),]
     
     # 为 Free Proxy 网站 生成抓取任务
     # http://free-proxy.cz/en/proxylist/main/1
+    @crawl_source("free_proxy", rate=0.5, burst=2, concurrency=2)
     def produce_job_for_FreeProxy(self):
         # callback
-        def crawl_FreeProxy_callback(content: str):
-            count_of_added_proxy = 0
-            soup = BeautifulSoup(content, "lxml")
-            for tr_node in soup.select("#proxy_list > tbody > tr"):
-                ip, port, https, anonymity_small_node = "-1.-1.-1.-1", "-1", False, True
-                td_node_list = tr_node.select("td")
-                try:
-                    # 获取 ip
-                    ip_script_node = td_node_list[0].script
-                    # document.write(Base64.decode("MTM0LjEyMi4xMjMuODI="))
-                    match_group = re.match(r"document.write\(Base64.decode\(\"(?P<encoded_ip>.+)\"\)\)", ip_script_node.string)
-                    ip = base64.b64decode(match_group.groupdict().get("encoded_ip", None)).decode("utf-8")
-
-                    # 获取 port
-                    port_span_node = td_node_list[1].span
-                    port = port_span_node.string
-
-                    # 获取 Http 判断
-                    https_small_node = td_node_list[2].small
-                    https = https_small_node.string == "HTTPS"
-
-                    # 判断是否为透明代理 略过透明代理
-                    anonymity_small_node = td_node_list[6].small
-                    transparent = anonymity_small_node.string == "Transparent"
-                except Exception as e:
-                    logging.error("解析 FreeProxy 异常 %s traceback.format_exc():____%s tr_node_list %s" % (
-                        e,
-                        traceback.format_exc(),
-                        td_node_list
-                    ))
-                    continue
-
-                if not transparent:
-                    # 匿名代理 添加到数据库中
-                    proxy_item = ProxyItem(ip=ip, port=port, https=https)
-                    is_added = self.storage.add(proxy_item)
-                    count_of_added_proxy += is_added
-
-            return count_of_added_proxy
+        async def crawl_FreeProxy_callback(content: str):
+            return await self.add_proxy_rows(await self.parse_in_process("free_proxy", content))
 
         crawl_job_list: List[CrawlJob] = list()
         url_template = "http://free-proxy.cz/en/proxylist/main/{}"
         for page_index in range(self.page_count_for_freeproxy):
             target_url = url_template.format(page_index + 1)
-            crawl_job_list.append(CrawlJob(target_url=target_url, callback=crawl_FreeProxy_callback))
-        return crawl_job_list
-
-
-
+            crawl_job_list.append(CrawlJob(target_url=target_url, source="free_proxy", callback=crawl_FreeProxy_callback))
+        return crawl_job_list
\ No newline at end of file
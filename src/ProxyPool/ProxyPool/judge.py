@@ -0,0 +1,41 @@
+'''
+代理验证使用的回显服务 与 https://httpbin.org/ip 一致 返回 {"origin": 客户端地址}
+请求头中带有 X-Forwarded-For 时 origin 为 "X-Forwarded-For, 客户端地址" 透明代理因此无法通过验证
+
+    cd src/ProxyPool
+    python -m ProxyPool.judge --host 0.0.0.0 --port 8899
+
+代理需要能够访问此服务 部署在公网地址后 将 http://<地址>:8899/ip 加入 production.cfg 的 validate_targets
+'''
+import argparse
+
+from aiohttp import web
+
+# 回显客户端地址
+async def handle_ip(request: web.Request) -> web.Response:
+    origin = request.remote
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for: origin = "{}, {}".format(forwarded_for, origin)
+    return web.json_response({"origin": origin})
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/ip", handle_ip)
+    return app
+
+# 在当前事件循环中启动回显服务 返回的 AppRunner 用于关闭服务
+async def start_judge(host: str = "127.0.0.1", port: int = 8899) -> web.AppRunner:
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="代理验证回显服务")
+    arg_parser.add_argument("--host", default="0.0.0.0")
+    arg_parser.add_argument("--port", type=int, default=8899)
+    args = arg_parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port, access_log=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+'''
+Prometheus 指标 ProxyPool 进程通过 metrics_port 暴露 WebAPI 通过 /metrics 暴露
+与 storage.py models.py 一样 WebAPI/proxy/metrics.py 为此文件的副本 修改后需要同步
+'''
+import functools, inspect, time
+from typing import Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# 网络请求 job_type 为 crawl / validate
+FETCH_LATENCY = Histogram(
+    "proxypool_fetch_seconds", "请求耗时 包括建立连接与读取响应", ["job_type", "error"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 10, 15, 20, 30)
+)
+FETCH_IN_FLIGHT = Gauge("proxypool_fetch_in_flight", "正在进行的请求数量", ["job_type"])
+SEMAPHORE_WAIT = Histogram(
+    "proxypool_semaphore_wait_seconds", "等待并发请求数量限制的时间", ["job_type"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30)
+)
+QUEUE_DEPTH = Gauge("proxypool_queue_depth", "任务队列中等待处理的任务数量", ["queue"])
+CRAWL_REQUEUED = Counter("proxypool_crawl_requeued_total", "重新入队的抓取任务数量", ["source", "reason"])
+
+# 页面解析
+PARSE_LATENCY = Histogram(
+    "proxypool_parse_seconds", "解析页面的耗时 包括进程池中排队的时间", ["source"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+# Redis
+REDIS_LATENCY = Histogram(
+    "proxypool_redis_seconds", "Storage 方法的耗时 包括 Redis 往返", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+# 多进程模式下 取各进程中的最大值 各进程统计的是同一个代理池 prometheus_client 0.14 不支持 livemax
+POOL_SIZE = Gauge("proxypool_pool_size", "各分数区间的代理数量", ["band"], multiprocess_mode="max")
+
+
+# 类装饰器 为类中全部公开的协程方法记录 REDIS_LATENCY 标签为方法名
+def observe_redis_calls(cls):
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(func): continue
+        setattr(cls, name, _observe_redis_call(name, func))
+    return cls
+
+def _observe_redis_call(name: str, func: Callable) -> Callable:
+    histogram = REDIS_LATENCY.labels(name)
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+    return wrapper
@@ -1,11 +1,17 @@
-import asyncio, logging, sys, traceback, time
-from asyncio import Semaphore, Event, Queue
-from typing import Dict
+import asyncio, logging, sys, traceback, time, itertools, random
+from typing import List, Dict
+from types import SimpleNamespace
+from asyncio import Semaphore, Event, Queue, QueueFull
 
 import aiohttp
 
-from .models import ProxyItem, JobBase, CrawlJob, ValidateJob, JobType
-from .storage import ProxyPoolStorage
+from .models import ProxyItem, JobBase, CrawlJob, ValidateJob, JobType, FetchResult, FetchError
+from .storage import AsyncProxyPoolStorage
+from .ratelimit import SourceLimiter
+from .metrics import FETCH_LATENCY, FETCH_IN_FLIGHT, SEMAPHORE_WAIT, QUEUE_DEPTH, CRAWL_REQUEUED
+
+# 无法连接到代理的失败原因
+PROXY_CONNECT_ERRORS = {FetchError.CONNECT_REFUSED, FetchError.CONNECT_TIMEOUT}
 
 # 消费 CrawlJobFactory 以及 ValidateJobFactory 产生的任务
 # 管理网络请求
@@ -54,123 +60,298 @@ class NetManager:
     def __init__(
         self,
         *,
-        timeout = 20, # 请求超时时间
+        timeout = 20, # 请求超时时间 单位秒
+        connect_timeout = 5, # 建立连接的超时时间 单位秒 无法连接的代理很快失败
+        read_timeout = 10, # 建立连接后 两次读取数据之间的超时时间 单位秒
         max_retry_count = 10, # CrawlJob 最多尝试次数
+        crawl_retry_base_delay = 1, # CrawlJob 第一次重试前等待的时间 单位秒 之后每次重试加倍
+        crawl_retry_max_delay = 60, # CrawlJob 重试前等待时间的上限 单位秒
         max_concurrent_request = 2000, # 最大并发请求数量
+        crawl_worker_count = 20, # 抓取协程数量
+        validate_worker_count = 200, # 验证协程数量
+        validate_queue_size = 1000, # 验证任务队列长度 队列满时生产者等待
+        fast_validate_worker_count = 20, # 快速验证协程数量 只处理新抓取代理的验证任务
+        fast_validate_queue_size = 5000, # 快速验证任务队列长度 队列满时不加入 由到期验证处理
+        validate_targets: List[str] = None, # 验证请求的目标地址 轮流使用 响应格式与 https://httpbin.org/ip 一致
+        crawl_connector_limit = 100, # 抓取连接池的连接总数上限 0 表示不限制
+        crawl_connector_limit_per_host = 10, # 抓取连接池中每个目标的连接数上限 0 表示不限制
+        crawl_keepalive_timeout = 30, # 抓取连接空闲保持时间 单位秒 抓取源数量少 复用连接
+        validate_connector_limit = 0, # 验证连接池的连接总数上限 0 表示不限制 并发已由验证协程数量限制
+        validate_connector_limit_per_host = 0, # 验证连接池中每个目标的连接数上限 0 表示不限制
+        validate_keepalive_timeout = 0, # 验证连接空闲保持时间 单位秒 0 表示请求结束后关闭连接 每个代理很久才验证一次 不必保持
+        dns_cache_ttl = 300, # DNS 缓存时间 单位秒
     ):
         self.crawl_job_queue = Queue()
-        self.validate_job_queue = Queue()
-        self.timeout = timeout
+        self.validate_job_queue = Queue(maxsize=validate_queue_size)
+        # 新抓取代理的验证任务 由独立的协程处理 不占用也不阻塞定期验证的协程
+        self.fast_validate_job_queue = Queue(maxsize=fast_validate_queue_size)
+        QUEUE_DEPTH.labels("crawl").set_function(self.crawl_job_queue.qsize)
+        QUEUE_DEPTH.labels("validate").set_function(self.validate_job_queue.qsize)
+        QUEUE_DEPTH.labels("fast_validate").set_function(self.fast_validate_job_queue.qsize)
+        self.crawl_worker_count = crawl_worker_count
+        self.validate_worker_count = validate_worker_count
+        self.fast_validate_worker_count = fast_validate_worker_count
+        self.validate_targets = validate_targets or ["https://httpbin.org/ip"]
+        self._validate_target_cycle = itertools.cycle(self.validate_targets)
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout, sock_read=read_timeout)
         self.max_retry_count = max_retry_count
+        self.crawl_retry_base_delay = crawl_retry_base_delay
+        self.crawl_retry_max_delay = crawl_retry_max_delay
         self.semaphore_max_concurrent_request = Semaphore(max_concurrent_request)
-        self.storage = ProxyPoolStorage()
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
+        self.storage = AsyncProxyPoolStorage()
+        self.crawl_connector_options = dict(
+            limit=crawl_connector_limit, limit_per_host=crawl_connector_limit_per_host,
+            keepalive_timeout=crawl_keepalive_timeout, ttl_dns_cache=dns_cache_ttl
+        )
+        self.validate_connector_options = dict(
+            limit=validate_connector_limit, limit_per_host=validate_connector_limit_per_host,
+            keepalive_timeout=validate_keepalive_timeout, ttl_dns_cache=dns_cache_ttl
+        )
+        # 抓取与验证使用不同的 ClientSession 连接复用方式互不影响 在 run 中创建
+        self.crawl_session: aiohttp.ClientSession = None
+        self.validate_session: aiohttp.ClientSession = None
+        # 抓取源名称 -> 限速器 由 ProxyPool 设置 没有限速器的抓取源不限速
+        self.crawl_source_limiters: Dict[str, SourceLimiter] = dict()
         self.event_crawl_job_finish = NetManager.EventCrawlJobFinish()
         self.event_validate_job_finish = NetManager.EventValidateJobFinish()
 
-    # 启动 consumer 
+    # 创建 ClientSession 需要在事件循环中调用 通过 TraceConfig 记录建立连接的耗时
+    @staticmethod
+    def _create_session(*, limit: int, limit_per_host: int, keepalive_timeout: float, ttl_dns_cache: int) -> aiohttp.ClientSession:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(NetManager._on_connection_create_start)
+        trace_config.on_connection_create_end.append(NetManager._on_connection_create_end)
+        # keepalive_timeout 与 force_close 不能同时设置
+        if keepalive_timeout > 0: keepalive_options = dict(keepalive_timeout=keepalive_timeout)
+        else: keepalive_options = dict(force_close=True)
+        connector = aiohttp.TCPConnector(
+            limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=ttl_dns_cache, **keepalive_options
+        )
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    # 启动 consumer 需要在事件循环中调用
     def run(self):
-        asyncio.gather(self.crawl_job_consumer(), self.validate_job_consumer())
+        if self.crawl_session is None: self.crawl_session = self._create_session(**self.crawl_connector_options)
+        if self.validate_session is None: self.validate_session = self._create_session(**self.validate_connector_options)
+        asyncio.gather(
+            *[ self.crawl_job_worker() for _ in range(self.crawl_worker_count) ],
+            *[ self.validate_job_worker() for _ in range(self.validate_worker_count) ],
+            *[ self.fast_validate_job_worker() for _ in range(self.fast_validate_worker_count) ]
+        )
+
+    # 关闭 ClientSession
+    async def close(self):
+        for session in (self.crawl_session, self.validate_session):
+            if session is not None: await session.close()
+        self.crawl_session, self.validate_session = None, None
 
     # 向队列中添加任务 不同任务添加到不同队列中
     def append_job(self, job: JobBase) -> None:
         if job.job_type == JobType.CRAWL: self.crawl_job_queue.put_nowait(job)
         else: self.validate_job_queue.put_nowait(job)
 
-    # 向互联网中请求 url 数据
-    async def fetch_content(self, url: str, proxy_item: ProxyItem) -> str:
+    # 向队列中添加任务 队列已满时等待
+    async def put_job(self, job: JobBase) -> None:
+        if job.job_type == JobType.CRAWL: await self.crawl_job_queue.put(job)
+        else: await self.validate_job_queue.put(job)
+
+    # 向快速验证队列中添加任务 队列已满时丢弃 返回是否入队
+    def append_fast_validate_job(self, job: ValidateJob) -> bool:
+        try:
+            self.fast_validate_job_queue.put_nowait(job)
+        except QueueFull:
+            return False
+        return True
+
+    # 等待已入队的 CrawlJob 全部处理完毕 并触发完成事件
+    # 重试的任务在重新入队之后才对原任务调用 task_done 因此 join 返回时不存在待重试的任务
+    async def wait_crawl_jobs_done(self):
+        await self.crawl_job_queue.join()
+        self.event_crawl_job_finish.set()
+
+    # 等待已入队的 ValidateJob 全部处理完毕 并触发完成事件
+    async def wait_validate_jobs_done(self):
+        await self.validate_job_queue.join()
+        self.event_validate_job_finish.set()
+
+    # TraceConfig 回调 trace_request_ctx 为 fetch_content 中传入的 SimpleNamespace
+    @staticmethod
+    async def _on_connection_create_start(session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx.connect_start = time.perf_counter()
+
+    @staticmethod
+    async def _on_connection_create_end(session, trace_config_ctx, params):
+        ctx = trace_config_ctx.trace_request_ctx
+        ctx.connect_time = time.perf_counter() - ctx.connect_start
+
+    # 由请求异常判断失败的原因 超时发生在连接建立之前为连接超时 之后为读取超时
+    @staticmethod
+    def classify_error(e: Exception, trace_ctx: SimpleNamespace) -> FetchError:
+        if isinstance(e, asyncio.TimeoutError):
+            if trace_ctx.connect_start is not None and trace_ctx.connect_time is None: return FetchError.CONNECT_TIMEOUT
+            return FetchError.READ_TIMEOUT
+        if isinstance(e, aiohttp.ClientConnectorError) and isinstance(e.os_error, ConnectionRefusedError):
+            return FetchError.CONNECT_REFUSED
+        if isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, OSError)):
+            return FetchError.CONNECTION_ERROR
+        return FetchError.OTHER
+
+    # 向互联网中请求 url 数据 返回响应内容 失败原因 以及建立连接 请求总计的耗时
+    # session 为 None 时使用抓取的 ClientSession job_type 为指标的标签
+    async def fetch_content(
+        self, url: str, proxy_item: ProxyItem, session: aiohttp.ClientSession = None, job_type: JobType = JobType.CRAWL
+    ) -> FetchResult:
         logging.debug("新建请求 url: {} proxy: {}".format(url, proxy_item))
-        status_code, content = None, ""
+        result = FetchResult()
+        trace_ctx = SimpleNamespace(connect_start=None, connect_time=None)
+        job_type_label = job_type.name.lower()
+        start_time = None
         try:
             headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.142 Safari/537.36"}
             proxy = "http://{ip}:{port}".format(**proxy_item.dict()) if proxy_item else None
+            wait_start_time = time.perf_counter()
             async with self.semaphore_max_concurrent_request:
-                async with self.session.get(
-                    url, 
-                    proxy=proxy,
-                    headers=headers,
-                    timeout=self.timeout
-                ) as resp:
-                    status_code, content = resp.status, await resp.text()
+                start_time = time.perf_counter()
+                SEMAPHORE_WAIT.labels(job_type_label).observe(start_time - wait_start_time)
+                with FETCH_IN_FLIGHT.labels(job_type_label).track_inprogress():
+                    async with (session or self.crawl_session).get(
+                        url, 
+                        proxy=proxy,
+                        headers=headers,
+                        timeout=self.timeout,
+                        trace_request_ctx=trace_ctx
+                    ) as resp:
+                        result.status, content = resp.status, await resp.text()
+                        result.total_time = time.perf_counter() - start_time
+                        if resp.status == 200: result.content = content
+                        else: result.error = FetchError.HTTP_STATUS
         except Exception as e:
-            pass
-        return content if status_code == 200 else ""
+            result.error = self.classify_error(e, trace_ctx)
+            logging.debug("请求失败 url: {} proxy: {} 原因: {} {!r}".format(url, proxy_item, result.error.value, e))
+        result.connect_time = trace_ctx.connect_time
+        if start_time is not None:
+            FETCH_LATENCY.labels(job_type_label, result.error.value).observe(time.perf_counter() - start_time)
+        return result
     
-    # 消费 CrawlJob
-    async def crawl_job_consumer(self):
-        task2job: Dict[asyncio.Task, CrawlJob] = dict()
-        # task callback
-        def _on_completed(task: asyncio.Task):
-            # 任务重启
-            def _crawl_job_retry(crawl_job: CrawlJob):
-                if crawl_job.retry_count < self.max_retry_count: # 请求失败 且重试次数小于指定值 重新入队 等待下次调度
-                    crawl_job.retry_count += 1
-                    self.append_job(crawl_job)
-                else: # 请求失败 耗尽重试次数
-                    self.event_crawl_job_finish.add_page_fail_count()
-
-            crawl_job: CrawlJob = task2job[task]
-            html_content:str = task.result()
-
-            if html_content != "": # 正确获取 url 内容 调用回调
-                count_added_proxy = 0
-                try:
-                    count_added_proxy = crawl_job.callback(html_content)
-                except Exception as e: # 回调异常 重启任务
-                    _crawl_job_retry(crawl_job)
-                    logging.error("Crawl Job 回调异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
-                    # 将错误内容写至日志目录中
-                    with open("./production/log/crawl_exception_{}.html".format(time.time()), "w") as f:
-                        f.write(html_content)
-                else: # 回调成功 成功向代理池中添加代理
-                    self.event_crawl_job_finish.add_page_count()
-                    self.event_crawl_job_finish.add_proxy_count(count_added_proxy)
-                    logging.info("完成抓取任务 {} 添加代理 {} 个".format(crawl_job.target_url, count_added_proxy))
-            else: # 获取 html content 为空 重启任务
-                _crawl_job_retry(crawl_job)
-
-            if task in task2job: del task2job[task]
-            else: logging.error("task not int task2job")
-
-            # 触发 crawl job 全部完成事件
-            if len(task2job) == 0 and self.crawl_job_queue.qsize() == 0:
-                self.event_crawl_job_finish.set()
-        
-        while True: # 循环监听队列
+    # 为 CrawlJob 选择代理 从前三十中随机选择此任务未失败过的代理
+    # 没有可用代理 或最后一次重试时 返回 None 直接连接
+    async def choose_crawl_proxy(self, crawl_job: CrawlJob) -> ProxyItem:
+        if crawl_job.retry_count >= self.max_retry_count: return None
+        proxy_list = [ proxy for proxy in await self.storage.get_top_30() if proxy.key not in crawl_job.failed_proxy_keys ]
+        if len(proxy_list) == 0: return None
+        return random.choice(proxy_list)
+
+    # 重试前等待的时间 指数退避 并在后一半区间内随机 避免重试集中在同一时刻
+    def crawl_retry_delay(self, retry_count: int) -> float:
+        delay = min(self.crawl_retry_base_delay * 2 ** (retry_count - 1), self.crawl_retry_max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # 延迟结束 重新入队 之后才对上一次出队调用 task_done
+    def _requeue_crawl_job(self, crawl_job: CrawlJob):
+        self.crawl_job_queue.put_nowait(crawl_job)
+        self.crawl_job_queue.task_done()
+
+    # 处理单个 CrawlJob 抓取页面 并在事件循环中等待回调写入 Storage
+    # 返回任务是否等待重新入队 等待重新入队的任务由 _requeue_crawl_job 调用 task_done
+    async def handle_crawl_job(self, crawl_job: CrawlJob) -> bool:
+        # 抓取源限速 超出限制时不占用抓取协程 延迟后重新入队 协程继续处理其他抓取源的任务
+        limiter = self.crawl_source_limiters.get(crawl_job.source)
+        if limiter is not None and not limiter.try_acquire():
+            CRAWL_REQUEUED.labels(crawl_job.source, "rate_limited").inc()
+            asyncio.get_running_loop().call_later(limiter.retry_after(), self._requeue_crawl_job, crawl_job)
+            return True
+        try:
+            return await self._handle_crawl_job(crawl_job)
+        finally:
+            if limiter is not None: limiter.release()
+
+    async def _handle_crawl_job(self, crawl_job: CrawlJob) -> bool:
+        proxy_item = await self.choose_crawl_proxy(crawl_job)
+
+        # 任务重启 记录失败的代理 延迟后重新入队
+        # 无法连接到代理时 与抓取的目标无关 不等待 立即换用其他代理重试
+        def _crawl_job_retry(crawl_job: CrawlJob, error: FetchError = FetchError.OTHER) -> bool:
+            if proxy_item is not None: crawl_job.failed_proxy_keys.add(proxy_item.key)
+            if crawl_job.retry_count < self.max_retry_count: # 请求失败 且重试次数小于指定值 延迟后重新入队 等待下次调度
+                crawl_job.retry_count += 1
+                CRAWL_REQUEUED.labels(crawl_job.source, "retry").inc()
+                if proxy_item is not None and error in PROXY_CONNECT_ERRORS: delay = 0
+                else: delay = self.crawl_retry_delay(crawl_job.retry_count)
+                asyncio.get_running_loop().call_later(delay, self._requeue_crawl_job, crawl_job)
+                return True
+            else: # 请求失败 耗尽重试次数
+                self.event_crawl_job_finish.add_page_fail_count()
+                return False
+
+        fetch_result = await self.fetch_content(crawl_job.target_url, proxy_item)
+        html_content: str = fetch_result.content
+
+        if html_content != "": # 正确获取 url 内容 调用回调
+            count_added_proxy = 0
+            try:
+                count_added_proxy = await crawl_job.callback(html_content)
+            except Exception as e: # 回调异常 重启任务
+                logging.error("Crawl Job 回调异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+                # 将错误内容写至日志目录中
+                with open("./production/log/crawl_exception_{}.html".format(time.time()), "w") as f:
+                    f.write(html_content)
+                return _crawl_job_retry(crawl_job)
+            else: # 回调成功 成功向代理池中添加代理
+                self.event_crawl_job_finish.add_page_count()
+                self.event_crawl_job_finish.add_proxy_count(count_added_proxy)
+                logging.info("完成抓取任务 {} 添加代理 {} 个".format(crawl_job.target_url, count_added_proxy))
+                return False
+        else: # 获取 html content 为空 重启任务
+            return _crawl_job_retry(crawl_job, fetch_result.error)
+
+    # 抓取协程 循环从队列中取出 CrawlJob 处理
+    async def crawl_job_worker(self):
+        while True:
             crawl_job: CrawlJob = await self.crawl_job_queue.get()
-            task = asyncio.create_task(self.fetch_content(crawl_job.target_url, self.storage.get()))
-            task.add_done_callback(_on_completed)
-            task2job[task] = crawl_job
-            logging.info("添加 抓取任务 {}".format(crawl_job))
-
-    # 消费 ValidateJob
-    async def validate_job_consumer(self):
-        task2job: Dict[asyncio.Task, ValidateJob] = dict()
-        # task callback
-        def _on_completed(task: asyncio.Task):
-            validate_job: ValidateJob = task2job[task]
-            html_content: str = task.result()
-            is_activated = False
+            logging.info("开始 抓取任务 {}".format(crawl_job))
+            is_requeued = False
             try:
-                is_activated = validate_job.callback(html_content, validate_job.proxy_item)
+                is_requeued = await self.handle_crawl_job(crawl_job)
             except Exception as e:
-                logging.error("代理认证回调异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
-            if is_activated:
-                self.event_validate_job_finish.add_count_activated_proxy()
+                self.event_crawl_job_finish.add_page_fail_count()
+                logging.error("抓取任务异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+            finally:
+                if not is_requeued: self.crawl_job_queue.task_done()
 
-            if task in task2job: del task2job[task]
-            else: logging.error("task not in task2boj")
-            logging.debug("完成验证任务, 代理:{}, 可用否: {}".format(validate_job.proxy_item, is_activated))
-
-            # 触发 validate job 全部完成事件
-            if len(task2job) == 0 and self.validate_job_queue.qsize() == 0:
-                self.event_validate_job_finish.set()
+    # 处理单个 ValidateJob 在事件循环中等待回调写入 Storage
+    async def handle_validate_job(self, validate_job: ValidateJob) -> bool:
+        fetch_result: FetchResult = await self.fetch_content(
+            next(self._validate_target_cycle), validate_job.proxy_item, self.validate_session, JobType.VALIDATE
+        )
+        is_activated = False
+        try:
+            is_activated = await validate_job.callback(fetch_result, validate_job.proxy_item)
+        except Exception as e:
+            logging.error("代理认证回调异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+        return is_activated
 
-        while True: # 循环监听队列
+    # 验证协程 循环从队列中取出 ValidateJob 处理 同时运行的验证任务数量等于协程数量
+    async def validate_job_worker(self):
+        while True:
             validate_job: ValidateJob = await self.validate_job_queue.get()
             self.event_validate_job_finish.add_count_total_proxy()
-            task = asyncio.create_task(self.fetch_content("https://httpbin.org/ip", validate_job.proxy_item))
-            task.add_done_callback(_on_completed)
-            task2job[task] = validate_job
+            try:
+                is_activated = await self.handle_validate_job(validate_job)
+                if is_activated: self.event_validate_job_finish.add_count_activated_proxy()
+                logging.debug("完成验证任务, 代理:{}, 可用否: {}".format(validate_job.proxy_item, is_activated))
+            except Exception as e:
+                logging.error("验证任务异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+            finally:
+                self.validate_job_queue.task_done()
 
-            logging.debug("添加 验证任务 {}".format(validate_job))
\ No newline at end of file
+    # 快速验证协程 处理新抓取代理的验证任务 不计入定期验证的统计
+    async def fast_validate_job_worker(self):
+        while True:
+            validate_job: ValidateJob = await self.fast_validate_job_queue.get()
+            try:
+                is_activated = await self.handle_validate_job(validate_job)
+                logging.debug("完成快速验证任务, 代理:{}, 可用否: {}".format(validate_job.proxy_item, is_activated))
+            except Exception as e:
+                logging.error("快速验证任务异常: %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+            finally:
+                self.fast_validate_job_queue.task_done()
@@ -0,0 +1,109 @@
+from typing import List, Tuple, Dict, Callable
+import re, base64, logging
+
+import lxml.html
+from lxml import etree
+
+# 抓取页面解析函数
+# 全部为模块级纯函数 参数为页面 html 内容 返回 (ip, port, https, anonymity) 列表
+# anonymity 取值见 models.ANONYMITY_LEVELS 页面中没有匿名度或无法识别时为空字符串
+# 解析函数在 CrawlJobFactory 的进程池中运行 不访问 Storage 也不依赖事件循环
+ProxyRow = Tuple[str, int, bool, str]
+
+# 抓取源名称 -> 解析函数
+PARSERS: Dict[str, Callable[[str], List[ProxyRow]]] = dict()
+
+# 注册抓取源的解析函数
+def register_parser(source: str):
+    def decorator(func: Callable[[str], List[ProxyRow]]):
+        PARSERS[source] = func
+        return func
+    return decorator
+
+# 按抓取源名称解析页面 在子进程中根据名称查找解析函数
+def parse_page(source: str, content: str) -> List[ProxyRow]:
+    return PARSERS[source](content)
+
+# 构建 html 文档树 内容为空时返回 None
+def _parse_html(content: str):
+    if content.strip() == "": return None
+    return lxml.html.fromstring(content)
+
+# 单元格的全部文本
+CELL_TEXT_XPATH = etree.XPath("string(.)")
+
+
+# https://www.xicidaili.com/nn/1
+XICIDAILI_ROW_XPATH = etree.XPath("//table[@id='ip_list']//tr[position() > 1]")
+XICIDAILI_CELL_XPATH = etree.XPath("./td")
+XICIDAILI_ANONYMITY = {"透明": "transparent", "普匿": "anonymous", "高匿": "elite"}
+
+@register_parser("xicidaili")
+def parse_xicidaili(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    root = _parse_html(content)
+    if root is None: return row_list
+    for tr_node in XICIDAILI_ROW_XPATH(root):
+        td_node_list = XICIDAILI_CELL_XPATH(tr_node)
+        row_list.append((
+            CELL_TEXT_XPATH(td_node_list[1]).strip(),
+            int(CELL_TEXT_XPATH(td_node_list[2])),
+            CELL_TEXT_XPATH(td_node_list[5]).strip() == "HTTPS",
+            XICIDAILI_ANONYMITY.get(CELL_TEXT_XPATH(td_node_list[4]).strip(), "")
+        ))
+    return row_list
+
+
+# https://free-proxy-list.net/
+FREE_PROXY_LIST_ROW_XPATH = etree.XPath("//table[@id='proxylisttable']//tbody/tr")
+FREE_PROXY_LIST_CELL_XPATH = etree.XPath("./td")
+FREE_PROXY_LIST_ANONYMITY = {"transparent": "transparent", "anonymous": "anonymous", "elite proxy": "elite"}
+
+@register_parser("free_proxy_list")
+def parse_free_proxy_list(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    root = _parse_html(content)
+    if root is None: return row_list
+    for tr_node in FREE_PROXY_LIST_ROW_XPATH(root):
+        td_node_list = FREE_PROXY_LIST_CELL_XPATH(tr_node)
+        row_list.append((
+            CELL_TEXT_XPATH(td_node_list[0]).strip(),
+            int(CELL_TEXT_XPATH(td_node_list[1])),
+            CELL_TEXT_XPATH(td_node_list[6]).strip() == "yes",
+            FREE_PROXY_LIST_ANONYMITY.get(CELL_TEXT_XPATH(td_node_list[4]).strip(), "")
+        ))
+    return row_list
+
+
+# http://free-proxy.cz/en/proxylist/main/1
+# ip 以 document.write(Base64.decode("MTM0LjEyMi4xMjMuODI=")) 的形式写在 script 中
+FREE_PROXY_ROW_XPATH = etree.XPath("//table[@id='proxy_list']/tbody/tr")
+FREE_PROXY_IP_XPATH = etree.XPath("string(./td[1]/script)")
+FREE_PROXY_PORT_XPATH = etree.XPath("string(./td[2]/span)")
+FREE_PROXY_HTTPS_XPATH = etree.XPath("string(./td[3]/small)")
+FREE_PROXY_ANONYMITY_XPATH = etree.XPath("string(./td[7]/small)")
+FREE_PROXY_ANONYMITY = {"Transparent": "transparent", "Anonymous": "anonymous", "High anonymity": "elite"}
+FREE_PROXY_ENCODED_IP_RE = re.compile(r"document.write\(Base64.decode\(\"(?P<encoded_ip>.+)\"\)\)")
+
+@register_parser("free_proxy")
+def parse_free_proxy(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    root = _parse_html(content)
+    if root is None: return row_list
+    for tr_node in FREE_PROXY_ROW_XPATH(root):
+        try:
+            # 获取 ip
+            match_group = FREE_PROXY_ENCODED_IP_RE.match(FREE_PROXY_IP_XPATH(tr_node))
+            ip = base64.b64decode(match_group.group("encoded_ip")).decode("utf-8")
+            # 获取 port
+            port = int(FREE_PROXY_PORT_XPATH(tr_node))
+            # 获取 Http 判断
+            https = FREE_PROXY_HTTPS_XPATH(tr_node) == "HTTPS"
+            # 获取匿名度 透明代理同样返回 由 CrawlJobFactory 决定是否略过
+            anonymity = FREE_PROXY_ANONYMITY.get(FREE_PROXY_ANONYMITY_XPATH(tr_node), "")
+        except Exception as e:
+            logging.error("解析 FreeProxy 异常 %s tr_node %s" % (e, etree.tostring(tr_node, encoding="unicode")))
+            continue
+
+        row_list.append((ip, port, https, anonymity))
+    return row_list
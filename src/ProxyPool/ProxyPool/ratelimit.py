@@ -0,0 +1,53 @@
+from typing import Callable
+import time, random
+
+# 抓取源的限速 令牌桶限制请求速率 并限制同时进行的请求数量
+# 只在事件循环中使用 不需要加锁
+class SourceLimiter:
+    def __init__(
+        self,
+        source: str,
+        *,
+        rate: float = 1.0, # 每秒允许的请求数量
+        burst: int = 1, # 令牌桶容量 允许短时间内连续发出的请求数量
+        concurrency: int = 1, # 同时进行的请求数量上限
+    ):
+        self.source = source
+        self.rate = rate
+        self.burst = max(int(burst), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.count_of_running = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # 尝试占用一个请求 成功后需要调用 release
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.count_of_running >= self.concurrency or self.tokens < 1: return False
+        self.tokens -= 1
+        self.count_of_running += 1
+        return True
+
+    def release(self):
+        self.count_of_running -= 1
+
+    # try_acquire 失败后 等待多久再次尝试 单位秒 带有随机抖动 避免等待的任务同时唤醒
+    def retry_after(self) -> float:
+        if self.tokens < 1: delay = (1 - self.tokens) / self.rate
+        else: delay = 0.5 / self.rate # 并发已满 等待正在进行的请求结束
+        return delay * random.uniform(1, 1.5)
+
+
+# 声明 produce_ 方法产生的 CrawlJob 所属的抓取源 以及抓取源默认的限速
+# 可以通过 CrawlJobFactory 配置中的 rate_limit_for_<source> burst_for_<source> concurrency_for_<source> 覆盖
+def crawl_source(source: str, *, rate: float = 1.0, burst: int = 1, concurrency: int = 1):
+    def decorator(func: Callable):
+        func.crawl_source = source
+        func.crawl_source_limit = dict(rate=rate, burst=burst, concurrency=concurrency)
+        return func
+    return decorator
@@ -0,0 +1,62 @@
+from typing import List
+import re, base64, logging, traceback
+
+from bs4 import BeautifulSoup
+
+from ProxyPool.parser import ProxyRow
+
+# 基于 BeautifulSoup 的旧版解析函数 仅作为基准测试的对照组
+# 逻辑与替换前 CrawlJobFactory 中的回调保持一致
+
+
+def parse_xicidaili(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    soup = BeautifulSoup(content, "lxml")
+    for tr_node in soup.select("#ip_list tr")[1:]:
+        td_node_list = tr_node.select("td")
+        row_list.append((
+            str(td_node_list[1].string),
+            int(td_node_list[2].string),
+            td_node_list[5].string == "HTTPS"
+        ))
+    return row_list
+
+
+def parse_free_proxy_list(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    soup = BeautifulSoup(content, "lxml")
+    for tr_node in soup.select("#proxylisttable tbody>tr"):
+        td_node_list = tr_node.select("td")
+        row_list.append((
+            str(td_node_list[0].string),
+            int(td_node_list[1].string),
+            td_node_list[6].string == "yes"
+        ))
+    return row_list
+
+
+def parse_free_proxy(content: str) -> List[ProxyRow]:
+    row_list: List[ProxyRow] = list()
+    soup = BeautifulSoup(content, "lxml")
+    for tr_node in soup.select("#proxy_list > tbody > tr"):
+        td_node_list = tr_node.select("td")
+        try:
+            ip_script_node = td_node_list[0].script
+            match_group = re.match(r"document.write\(Base64.decode\(\"(?P<encoded_ip>.+)\"\)\)", ip_script_node.string)
+            ip = base64.b64decode(match_group.groupdict().get("encoded_ip", None)).decode("utf-8")
+            port = int(td_node_list[1].span.string)
+            https = td_node_list[2].small.string == "HTTPS"
+            transparent = td_node_list[6].small.string == "Transparent"
+        except Exception as e:
+            logging.error("解析 FreeProxy 异常 %s traceback.format_exc():____%s" % (e, traceback.format_exc()))
+            continue
+        if not transparent:
+            row_list.append((ip, port, https))
+    return row_list
+
+
+BS4_PARSERS = {
+    "xicidaili": parse_xicidaili,
+    "free_proxy_list": parse_free_proxy_list,
+    "free_proxy": parse_free_proxy,
+}
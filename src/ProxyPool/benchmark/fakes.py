@@ -0,0 +1,107 @@
+'''
+基准测试使用的本地假服务 在独立进程中运行 不占用被测进程的事件循环
+
+- 假代理: 监听 proxy_host:proxy_port 连接到 127.a.b.c:proxy_port 即为使用代理 127.a.b.c
+  按代理地址确定固定的延迟 以 fail_rate 的概率断开连接 转发请求时以代理地址作为源地址 回显服务因此返回代理的 ip
+  proxy_host 需要为 0.0.0.0 才能接受 127.0.0.0/8 中全部地址的连接
+- 回显服务: ProxyPool.judge 监听 127.0.0.1:judge_port
+- 假抓取站点: 监听 127.0.0.1:site_port /<抓取源>/<路径> 返回 benchmark.pages 生成的页面 页面中的代理均为假代理
+'''
+from typing import List
+from urllib.parse import urlsplit
+import asyncio, random, zlib
+
+from aiohttp import web
+
+from ProxyPool.judge import start_judge
+from ProxyPool.models import ProxyItem
+from .pages import PAGE_RENDERERS, PageRow
+
+# 假代理地址 第 index 个代理为 127.x.y.z 跳过 127.0.0.0/16 避免与本地服务冲突
+def fake_proxy_ip(index: int) -> str:
+    index += 1 << 16
+    return "127.{}.{}.{}".format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+
+# 预先写入代理池的假代理 每隔 1 / dead_rate 个代理使用没有监听的端口 连接会被拒绝
+def fake_proxy_items(count: int, proxy_port: int, dead_port: int, dead_rate: float = 0.0) -> List[ProxyItem]:
+    dead_every = int(1 / dead_rate) if dead_rate > 0 else 0
+    return [
+        ProxyItem.construct(
+            ip=fake_proxy_ip(index),
+            port=dead_port if dead_every and index % dead_every == 0 else proxy_port,
+            https=False, anonymity="elite", country=""
+        )
+        for index in range(count)
+    ]
+
+# 假抓取站点页面中的代理 位于 127.128.0.0 之后 与预先写入的代理不重复
+def fake_page_rows(count: int, proxy_port: int, seed: int) -> List[PageRow]:
+    rand = random.Random(seed)
+    return [
+        (fake_proxy_ip((127 << 16) + rand.randint(0, 1 << 22)), proxy_port, False, rand.choice(["anonymous", "elite"]))
+        for _ in range(count)
+    ]
+
+
+class FakeProxy:
+    def __init__(self, *, latency: float = 0.05, fail_rate: float = 0.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+
+    # 每个代理固定的延迟 在 [0.5, 1.5) * latency 之间
+    def latency_of(self, proxy_ip: str) -> float:
+        return self.latency * (0.5 + zlib.crc32(proxy_ip.encode()) % 1000 / 1000)
+
+    # 只支持 http 目标的 GET 请求 以代理地址作为源地址转发 响应原样返回后关闭连接
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        proxy_ip = writer.get_extra_info("sockname")[0]
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            method, target, _ = head.split(b"\r\n", 1)[0].decode().split(" ", 2)
+            await asyncio.sleep(self.latency_of(proxy_ip))
+            if random.random() < self.fail_rate: return
+            if method != "GET":
+                writer.write(b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            url = urlsplit(target)
+            upstream_reader, upstream_writer = await asyncio.open_connection(url.hostname, url.port or 80, local_addr=(proxy_ip, 0))
+            try:
+                upstream_writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n".format(
+                    (url.path or "/") + ("?" + url.query if url.query else ""), url.netloc
+                ).encode())
+                writer.write(await upstream_reader.read())
+            finally:
+                upstream_writer.close()
+            await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# 假抓取站点 相同路径返回相同的页面
+def create_site_app(*, rows_per_page: int, proxy_port: int) -> web.Application:
+    async def handle_page(request: web.Request) -> web.Response:
+        source = request.match_info["source"]
+        if source not in PAGE_RENDERERS: raise web.HTTPNotFound()
+        row_list = fake_page_rows(rows_per_page, proxy_port, zlib.crc32(request.path.encode()))
+        return web.Response(text=PAGE_RENDERERS[source](row_list), content_type="text/html")
+    app = web.Application()
+    app.router.add_get("/{source}/{tail:.*}", handle_page)
+    return app
+
+async def serve_fakes(
+    *, proxy_host: str, proxy_port: int, judge_port: int, site_port: int,
+    latency: float, fail_rate: float, rows_per_page: int, ready = None
+):
+    await start_judge("127.0.0.1", judge_port)
+    site_runner = web.AppRunner(create_site_app(rows_per_page=rows_per_page, proxy_port=proxy_port), access_log=None)
+    await site_runner.setup()
+    await web.TCPSite(site_runner, "127.0.0.1", site_port).start()
+    await asyncio.start_server(FakeProxy(latency=latency, fail_rate=fail_rate).handle, proxy_host, proxy_port, backlog=4096)
+    if ready is not None: ready.set()
+    await asyncio.Event().wait()
+
+# multiprocessing.Process 的入口 ready 为 multiprocessing.Event 全部服务开始监听后设置
+def run_fakes(**kwargs):
+    asyncio.run(serve_fakes(**kwargs))
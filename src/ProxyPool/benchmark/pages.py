@@ -0,0 +1,105 @@
+from typing import List, Tuple, Dict, Callable
+import random, base64
+
+# 生成与各抓取源结构一致的代理列表页面 用于解析基准测试以及本地的假抓取站点
+# (ip, port, https, anonymity) anonymity 取值 transparent / anonymous / elite
+PageRow = Tuple[str, int, bool, str]
+
+# 生成 count 个随机代理行 相同 seed 生成的结果相同
+def random_rows(count: int, seed: int = 0) -> List[PageRow]:
+    rand = random.Random(seed)
+    row_list: List[PageRow] = list()
+    for _ in range(count):
+        row_list.append((
+            "{}.{}.{}.{}".format(rand.randint(1, 223), rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254)),
+            rand.choice([80, 3128, 8080, 8118, 9999, rand.randint(1024, 65535)]),
+            rand.random() < 0.5,
+            rand.choice(["transparent", "anonymous", "elite"]),
+        ))
+    return row_list
+
+# 页面中与代理无关的部分 使页面体积接近真实页面
+def _page_shell(title: str, body: str) -> str:
+    nav = "".join('<li><a href="/nav/{0}">导航 {0}</a></li>'.format(index) for index in range(40))
+    scripts = "".join('<script src="/static/js/{}.js"></script>'.format(index) for index in range(10))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title>{scripts}</head>'
+        '<body><div id="header"><ul class="nav">{nav}</ul></div>'
+        '<div id="body">{body}</div>'
+        '<div id="footer"><p>footer</p></div></body></html>'
+    ).format(title=title, scripts=scripts, nav=nav, body=body)
+
+
+# https://www.xicidaili.com/nn/1
+def render_xicidaili_page(row_list: List[PageRow]) -> str:
+    anonymity_text = {"transparent": "透明", "anonymous": "普匿", "elite": "高匿"}
+    tr_list = ['<tr><th class="country">国家</th><th>IP地址</th><th>端口</th><th>服务器地址</th><th class="country">是否匿名</th>'
+               '<th>类型</th><th class="country">速度</th><th class="country">连接时间</th><th width="8%">存活时间</th><th width="20%">验证时间</th></tr>']
+    for index, (ip, port, https, anonymity) in enumerate(row_list):
+        tr_list.append(
+            '<tr class="{odd}"><td class="country"><img src="//fs.xicidaili.com/images/flag/cn.png" alt="Cn" /></td>'
+            '<td>{ip}</td><td>{port}</td><td><a href="/2019-01-01/beijing">北京</a></td><td class="country">{anonymity}</td>'
+            '<td>{https}</td><td class="country"><div title="0.5秒" class="bar"><div class="bar_inner fast" style="width:90%"></div></div></td>'
+            '<td class="country"><div title="0.1秒" class="bar"><div class="bar_inner fast" style="width:95%"></div></div></td>'
+            '<td>1天</td><td>20-01-01 00:00</td></tr>'.format(
+                odd="odd" if index % 2 else "", ip=ip, port=port, anonymity=anonymity_text[anonymity], https="HTTPS" if https else "HTTP"
+            )
+        )
+    return _page_shell("国内高匿免费HTTP代理IP", '<table id="ip_list">{}</table>'.format("".join(tr_list)))
+
+
+# https://free-proxy-list.net/
+def render_free_proxy_list_page(row_list: List[PageRow]) -> str:
+    anonymity_text = {"transparent": "transparent", "anonymous": "anonymous", "elite": "elite proxy"}
+    tr_list = list()
+    for ip, port, https, anonymity in row_list:
+        tr_list.append(
+            '<tr><td>{ip}</td><td>{port}</td><td>US</td><td class="hm">United States</td><td>{anonymity}</td>'
+            '<td class="hm">no</td><td class="hx">{https}</td><td class="hm">1 minute ago</td></tr>'.format(
+                ip=ip, port=port, anonymity=anonymity_text[anonymity], https="yes" if https else "no"
+            )
+        )
+    table = (
+        '<table class="table table-striped table-bordered" cellspacing="0" width="100%" id="proxylisttable">'
+        '<thead><tr><th>IP Address</th><th>Port</th><th>Code</th><th class="hm">Country</th><th>Anonymity</th>'
+        '<th class="hm">Google</th><th class="hx">Https</th><th class="hm">Last Checked</th></tr></thead>'
+        '<tbody>{}</tbody></table>'
+    ).format("".join(tr_list))
+    return _page_shell("Free Proxy List", table)
+
+
+# http://free-proxy.cz/en/proxylist/main/1
+def render_free_proxy_page(row_list: List[PageRow]) -> str:
+    anonymity_text = {"transparent": "Transparent", "anonymous": "Anonymous", "elite": "High anonymity"}
+    tr_list = list()
+    for index, (ip, port, https, anonymity) in enumerate(row_list):
+        # 真实页面中 每隔若干行会插入一个广告行
+        if index % 10 == 5:
+            tr_list.append('<tr><td colspan="11"><div class="ad">ad</div></td></tr>')
+        tr_list.append(
+            '<tr><td style="text-align:center" class="left"><script type="text/javascript">document.write(Base64.decode("{encoded_ip}"))</script></td>'
+            '<td style=""><span class="fport" style=\'\'>{port}</span></td><td><small>{https}</small></td>'
+            '<td class="left"><div style="padding-left:2px"><img src="/flags/blank.gif" class="flag flag-us" alt="United States" /> '
+            '<a href="/en/proxylist/country/US/all/ping/all">United States</a></div></td><td class="small"><small>California</small></td>'
+            '<td class="small"><small>Los Angeles</small></td><td class="small"><small>{anonymity}</small></td>'
+            '<td><i class="icon-black icon-question-sign"></i> <small>1.2 kB/s</small><div class="progress"><div class="fill" style="width:8%;"></div></div></td>'
+            '<td><small>80.1%</small><div class="progress"><div class="fill" style="width:80%;"></div></div></td>'
+            '<td><small>1 min ago</small></td></tr>'.format(
+                encoded_ip=base64.b64encode(ip.encode("utf-8")).decode("utf-8"),
+                port=port, https="HTTPS" if https else "HTTP", anonymity=anonymity_text[anonymity]
+            )
+        )
+    table = (
+        '<table id="proxy_list" cellpadding="0" cellspacing="0"><thead><tr><th>IP address</th><th>Port</th><th>Protocol</th>'
+        '<th>Country</th><th>Region</th><th>City</th><th>Anonymity</th><th>Speed</th><th>Uptime</th><th>Response</th></tr></thead>'
+        '<tbody>{}</tbody></table>'
+    ).format("".join(tr_list))
+    return _page_shell("Free proxy list", table)
+
+
+# 抓取源名称 -> 页面生成函数 名称与 ProxyPool.parser.PARSERS 一致
+PAGE_RENDERERS: Dict[str, Callable[[List[PageRow]], str]] = {
+    "xicidaili": render_xicidaili_page,
+    "free_proxy_list": render_free_proxy_list_page,
+    "free_proxy": render_free_proxy_page,
+}
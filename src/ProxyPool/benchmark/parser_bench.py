@@ -0,0 +1,61 @@
+'''
+抓取页面解析基准测试 对比 lxml XPath 解析函数与旧版 BeautifulSoup 解析函数
+
+    cd src/ProxyPool
+    python -m benchmark.parser_bench --rows 300 --repeat 20
+
+优先使用 benchmark/samples/<source>.html 中保存的真实页面 不存在时使用 benchmark.pages 生成的页面
+'''
+from typing import Callable, List, Tuple
+import argparse, logging, os, time, zlib
+
+from ProxyPool.parser import PARSERS, ProxyRow
+from .bs4_parser import BS4_PARSERS
+from .pages import PAGE_RENDERERS, random_rows
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "samples")
+# 旧版解析函数只返回 (ip, port, https) 其中 free_proxy 略过透明代理 对比时同样处理
+BS4_SKIP_TRANSPARENT = {"free_proxy"}
+
+# 读取保存的页面 不存在时生成页面
+def load_page(source: str, rows: int) -> Tuple[str, str]:
+    path = os.path.join(SAMPLES_DIR, "{}.html".format(source))
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return f.read(), path
+    return PAGE_RENDERERS[source](random_rows(rows, seed=zlib.crc32(source.encode()))), "generated"
+
+# 平均每次解析的耗时 单位毫秒
+def time_parser(parse_func: Callable[[str], List[ProxyRow]], content: str, repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        parse_func(content)
+    return (time.perf_counter() - start_time) * 1000 / repeat
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="抓取页面解析基准测试")
+    arg_parser.add_argument("--rows", type=int, default=300, help="生成页面中代理的行数")
+    arg_parser.add_argument("--repeat", type=int, default=20, help="每个页面解析的次数")
+    args = arg_parser.parse_args()
+    # 解析函数遇到广告行会记录错误日志 基准测试中忽略
+    logging.disable(logging.CRITICAL)
+
+    print("{:<16} {:<10} {:>6} {:>10} {:>10} {:>8}".format("source", "page", "rows", "bs4 ms", "lxml ms", "speedup"))
+    for source, parse_func in PARSERS.items():
+        content, origin = load_page(source, args.rows)
+        lxml_rows, bs4_rows = parse_func(content), BS4_PARSERS[source](content)
+        compared_rows = [
+            (ip, port, https) for ip, port, https, anonymity in lxml_rows
+            if not (source in BS4_SKIP_TRANSPARENT and anonymity == "transparent")
+        ]
+        if sorted(compared_rows) != sorted(bs4_rows):
+            print("{:<16} 解析结果与 BeautifulSoup 不一致 lxml {} 行 bs4 {} 行".format(source, len(lxml_rows), len(bs4_rows)))
+            continue
+        bs4_ms = time_parser(BS4_PARSERS[source], content, args.repeat)
+        lxml_ms = time_parser(parse_func, content, args.repeat)
+        print("{:<16} {:<10} {:>6} {:>10.2f} {:>10.2f} {:>7.1f}x".format(
+            source, "saved" if origin != "generated" else origin, len(lxml_rows), bs4_ms, lxml_ms, bs4_ms / lxml_ms
+        ))
+
+if __name__ == "__main__":
+    main()
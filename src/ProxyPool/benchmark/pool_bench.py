@@ -0,0 +1,210 @@
+'''
+代理池基准测试 不访问互联网 也不需要 Redis 服务
+
+    cd src/ProxyPool
+    python -m benchmark.pool_bench --sizes 1000,10000,100000 --json bench.json
+
+假代理 回显服务 假抓取站点见 benchmark.fakes 在独立进程中运行 Storage 使用进程内的 fakeredis
+每个代理池大小在新的进程中测试 依次测量:
+- 写入: 以 add_many 写入 size 个假代理的耗时
+- 验证: 取出最多 validate_limit 个到期代理验证 每秒完成的验证数量
+- 抓取: 每个抓取源 crawl_pages 个页面的一轮抓取耗时
+- 接口: 在进程内调用 WebAPI 应用 各接口的 p50 / p99 延迟 包括路由 参数校验 内存快照与响应序列化 不包括 HTTP 解析与网络
+- 内存: 进程的峰值 RSS 包括 fakeredis 中的数据 不包括解析页面的子进程
+'''
+from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+import argparse, asyncio, importlib.util, json, logging, multiprocessing, os, resource, sys, time
+
+from .fakes import run_fakes, fake_proxy_items
+
+WEBAPI_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "WebAPI")
+
+# 测量的 WebAPI 接口 名称 -> 路径
+API_PATHS = {
+    "default": "/",
+    "random": "/random?random_range=30",
+    "weighted": "/random?random_range=30&weighted=true",
+    "filtered": "/random?random_range=30&anonymity=elite",
+    "fastest": "/fastest?count=10",
+    "batch": "/batch?n=50&min_score=0",
+    "page": "/all/page?count=500",
+}
+
+# 加载 WebAPI 应用 WebAPI 的 proxy 包中 storage models metrics 与 ProxyPool 中的相同
+# 以已导入的 ProxyPool 模块代替 指标不会重复注册 Storage 共用同一个 fakeredis
+# WebAPI 的 main.py 与 ProxyPool 的 main.py 同名 以文件路径加载
+def load_webapi():
+    sys.path.insert(0, WEBAPI_DIR)
+    for name in ("models", "metrics", "storage"):
+        sys.modules["proxy." + name] = importlib.import_module("ProxyPool." + name)
+    spec = importlib.util.spec_from_file_location("webapi_main", os.path.join(WEBAPI_DIR, "main.py"))
+    webapi_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(webapi_main)
+    return webapi_main
+
+# 以 ASGI 接口直接调用应用的 GET 请求 返回状态码
+async def asgi_get(app, url: str) -> int:
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "root_path": "",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "headers": [],
+        "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80),
+    }
+    status = None
+    async def receive():
+        return { "type": "http.request", "body": b"", "more_body": False }
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start": status = message["status"]
+    await app(scope, receive, send)
+    return status
+
+def percentile(sorted_list: List[float], ratio: float) -> float:
+    return sorted_list[min(int(len(sorted_list) * ratio), len(sorted_list) - 1)]
+
+async def bench_pool_size(size: int, options: dict) -> dict:
+    import fakeredis.aioredis
+    from ProxyPool import storage as storage_module
+    storage_module._async_redis_engine = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    from ProxyPool.jobfactory import CrawlJobFactory, ValidateJobFactory
+    from ProxyPool.network import NetManager
+
+    result = { "size": size }
+    storage = storage_module.AsyncProxyPoolStorage()
+    proxy_list = fake_proxy_items(size, options["proxy_port"], options["dead_port"], options["dead_rate"])
+    start_time = time.perf_counter()
+    for index in range(0, size, 1000):
+        await storage.add_many(proxy_list[index:index + 1000])
+    result["seed_seconds"] = time.perf_counter() - start_time
+
+    net_manager = NetManager(
+        timeout=10, connect_timeout=3, read_timeout=8, crawl_retry_base_delay=0.1,
+        validate_worker_count=options["validate_workers"],
+        validate_targets=["http://127.0.0.1:{}/ip".format(options["judge_port"])]
+    )
+    net_manager.run()
+
+    # 与 ProxyPool.validatejob_producer 相同 持续取出到期代理入队 直到达到 validate_limit
+    validate_job_factory = ValidateJobFactory()
+    validate_limit = min(size, options["validate_limit"])
+    count_of_claimed = 0
+    start_time = time.perf_counter()
+    while count_of_claimed < validate_limit:
+        validate_job_factory.claim_batch_size = min(500, validate_limit - count_of_claimed)
+        validate_job_list = await validate_job_factory.claim_due_jobs()
+        if len(validate_job_list) == 0: break
+        for validate_job in validate_job_list:
+            await net_manager.put_job(validate_job)
+        count_of_claimed += len(validate_job_list)
+    await net_manager.wait_validate_jobs_done()
+    await validate_job_factory.flush_validate_results()
+    validate_seconds = time.perf_counter() - start_time
+    result["validated"] = count_of_claimed
+    result["activated"] = net_manager.event_validate_job_finish.count_of_activated_proxy
+    result["validations_per_second"] = count_of_claimed / validate_seconds
+
+    # 抓取源限速放开 只测量抓取与解析 页面地址指向假抓取站点
+    source_limit_options = dict()
+    for source in ("xicidaili", "free_proxy_list", "free_proxy"):
+        source_limit_options.update({
+            "rate_limit_for_" + source: 1e6, "burst_for_" + source: 1000, "concurrency_for_" + source: 1000
+        })
+    crawl_job_factory = CrawlJobFactory(
+        crawl_page_count_for_xici=options["crawl_pages"],
+        crawl_page_count_for_freeproxy=options["crawl_pages"],
+        **source_limit_options
+    )
+    net_manager.crawl_source_limiters = crawl_job_factory.source_limiters
+    start_time = time.perf_counter()
+    for crawl_job in await crawl_job_factory.get_jobs():
+        crawl_job.target_url = "http://127.0.0.1:{}/{}{}".format(options["site_port"], crawl_job.source, urlsplit(crawl_job.target_url).path)
+        net_manager.append_job(crawl_job)
+    await net_manager.wait_crawl_jobs_done()
+    result["crawl_round_seconds"] = time.perf_counter() - start_time
+    result["crawled_pages"] = net_manager.event_crawl_job_finish.count_of_crawl_page
+    result["crawl_added"] = net_manager.event_crawl_job_finish.count_of_added_proxy
+    crawl_job_factory.parse_executor.shutdown()
+
+    webapi_main = load_webapi()
+    await webapi_main.startup()
+    api_latency: Dict[str, Dict[str, float]] = dict()
+    for name, path in API_PATHS.items():
+        latency_list: List[float] = list()
+        for _ in range(options["api_calls"]):
+            start_time = time.perf_counter()
+            status = await asgi_get(webapi_main.app, path)
+            latency_list.append((time.perf_counter() - start_time) * 1000)
+            if status != 200: raise RuntimeError("接口 {} 返回状态码 {}".format(path, status))
+        latency_list.sort()
+        api_latency[name] = { "p50_ms": percentile(latency_list, 0.5), "p99_ms": percentile(latency_list, 0.99) }
+    result["api_latency"] = api_latency
+    await webapi_main.snapshot.stop()
+
+    await net_manager.close()
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+# 子进程入口 解析页面的进程以 fork 启动 继承 logging.disable 忽略解析广告行的错误日志
+def run_pool_size(size: int, options: dict) -> dict:
+    multiprocessing.set_start_method("fork", force=True)
+    logging.disable(logging.CRITICAL)
+    return asyncio.run(bench_pool_size(size, options))
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="代理池基准测试")
+    arg_parser.add_argument("--sizes", default="1000,10000,100000", help="代理池大小 逗号分隔")
+    arg_parser.add_argument("--validate-limit", type=int, default=10000, help="每个代理池大小最多验证的代理数量")
+    arg_parser.add_argument("--validate-workers", type=int, default=200, help="验证协程数量")
+    arg_parser.add_argument("--crawl-pages", type=int, default=5, help="每个抓取源抓取的页数")
+    arg_parser.add_argument("--rows-per-page", type=int, default=300, help="假抓取站点每页代理的数量")
+    arg_parser.add_argument("--api-calls", type=int, default=1000, help="每个接口调用的次数")
+    arg_parser.add_argument("--latency-ms", type=float, default=50, help="假代理的平均延迟 单位毫秒")
+    arg_parser.add_argument("--fail-rate", type=float, default=0.05, help="假代理断开连接的概率")
+    arg_parser.add_argument("--dead-rate", type=float, default=0.2, help="无法连接的代理比例")
+    arg_parser.add_argument("--proxy-host", default="0.0.0.0", help="假代理监听的地址")
+    arg_parser.add_argument("--proxy-port", type=int, default=18890)
+    arg_parser.add_argument("--dead-port", type=int, default=18891, help="没有监听的端口 无法连接的代理使用此端口")
+    arg_parser.add_argument("--judge-port", type=int, default=18899)
+    arg_parser.add_argument("--site-port", type=int, default=18898)
+    arg_parser.add_argument("--json", help="结果以 JSON 格式写入此文件 便于与上一次的结果比较")
+    args = arg_parser.parse_args()
+    options = vars(args)
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    fakes_process = context.Process(target=run_fakes, daemon=True, kwargs=dict(
+        proxy_host=args.proxy_host, proxy_port=args.proxy_port, judge_port=args.judge_port, site_port=args.site_port,
+        latency=args.latency_ms / 1000, fail_rate=args.fail_rate, rows_per_page=args.rows_per_page, ready=ready
+    ))
+    fakes_process.start()
+    if not ready.wait(30): raise RuntimeError("假服务启动失败")
+
+    result_list: List[dict] = list()
+    try:
+        print("{:>8} {:>8} {:>10} {:>10} {:>10} {:>9} {:>8} {:>10}".format(
+            "size", "seed s", "validated", "activated", "valid/s", "crawl s", "pages", "peak MB"
+        ))
+        for size in [ int(size) for size in args.sizes.split(",") ]:
+            # 每个大小使用新的进程 峰值内存互不影响
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_pool_size, size, options).result()
+            result_list.append(result)
+            print("{size:>8} {seed_seconds:>8.2f} {validated:>10} {activated:>10} {validations_per_second:>10.1f} "
+                  "{crawl_round_seconds:>9.2f} {crawled_pages:>8} {peak_rss_mb:>10.1f}".format(**result))
+
+        print()
+        print("{:>8} {:<10} {:>10} {:>10}".format("size", "api", "p50 ms", "p99 ms"))
+        for result in result_list:
+            for name, latency in result["api_latency"].items():
+                print("{:>8} {:<10} {:>10.3f} {:>10.3f}".format(result["size"], name, latency["p50_ms"], latency["p99_ms"]))
+    finally:
+        fakes_process.terminate()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({ "options": options, "results": result_list }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
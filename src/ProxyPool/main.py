@@ -1,43 +1,120 @@
-import asyncio, logging, configparser, os
+import asyncio, logging, configparser, os, argparse, multiprocessing, socket
 
 from ProxyPool import ProxyPool ,create_proxypool
 from ProxyPool.models import ProxyItem
 
 
-async def main():
-    # 读取配置
+def read_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser()
     config.read(["./production/config/.cfg", "./production/config/production.cfg"], encoding="UTF-8")
+    return config
+
+# worker 为 --workers 启动的验证进程序号 None 为主进程
+async def main(args: argparse.Namespace, worker: int = None):
+    # 读取配置
+    config = read_config()
+    role = args.role or config.get("ProxyPool", "role")
+    metrics_port = config.getint("ProxyPool", "metrics_port")
+    shard_count, shard, consumer_name = 0, None, None
+    if worker is None and args.workers > 1:
+        # 主进程为 coordinator 按代理键的哈希 将到期代理分配给各 worker
+        role, shard_count = "coordinator", args.workers
+    elif worker is not None:
+        # standalone 的 worker 只验证自己分片的代理 validator 的 worker 共同读取共用的验证 Stream
+        if role == "standalone": shard = worker
+        role, consumer_name = "validator", "{}-worker-{}".format(socket.gethostname(), worker)
+        if metrics_port > 0: metrics_port += 1 + worker
 
-    # 日志配置
+    # 日志配置 worker 写入各自的日志文件
     numeric_level = getattr(logging, config.get("ProxyPool", "log_level").upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
+    log_name = "proxypool" if worker is None else "proxypool.worker{}".format(worker)
     logging.basicConfig(
-        filename="./production/log/proxypool.log" if os.getenv("PRODUCTION_ENV") else "proxypool.dev.log",
+        filename="./production/log/{}.log".format(log_name) if os.getenv("PRODUCTION_ENV") else "{}.dev.log".format(log_name),
         filemode="w",
         level=numeric_level,
         format="%(levelname)s - %(asctime)s : %(filename)s %(message)s",
     )
 
-    # 枚举出全部抓取任务 配置的抓取页数
+    # 枚举出全部抓取任务 配置的抓取页数 以及抓取源的限速
     crawl_job_page_count_dict = dict()
     for option_key in config.options("CrawlJobFactory"):
-        if option_key.startswith("crawl_page_count_for_"):
+        if option_key.startswith(("crawl_page_count_for_", "burst_for_", "concurrency_for_")):
             crawl_job_page_count_dict[option_key] = config.getint("CrawlJobFactory", option_key)
+        elif option_key.startswith("rate_limit_for_"):
+            crawl_job_page_count_dict[option_key] = config.getfloat("CrawlJobFactory", option_key)
 
     # 启动代理池
     proxy_pool = create_proxypool(
         crawl_job_interval_hour=config.getint("ProxyPool", "crawl_job_interval_hour"),
         validate_job_interval_minute=config.getint("ProxyPool", "validate_job_interval_minute"),
+        validate_poll_interval_second=config.getint("ProxyPool", "validate_poll_interval_second"),
         timeout=config.getint("ProxyPool", "timeout"),
+        connect_timeout=config.getint("ProxyPool", "connect_timeout"),
+        read_timeout=config.getint("ProxyPool", "read_timeout"),
         max_retry_count=config.getint("ProxyPool", "max_retry_count"),
+        crawl_retry_base_delay=config.getfloat("ProxyPool", "crawl_retry_base_delay"),
+        crawl_retry_max_delay=config.getfloat("ProxyPool", "crawl_retry_max_delay"),
         max_concurrent_request=config.getint("ProxyPool", "max_concurrent_request"),
+        crawl_worker_count=config.getint("ProxyPool", "crawl_worker_count"),
+        validate_worker_count=config.getint("ProxyPool", "validate_worker_count"),
+        validate_queue_size=config.getint("ProxyPool", "validate_queue_size"),
+        fast_validate_worker_count=config.getint("ProxyPool", "fast_validate_worker_count"),
+        fast_validate_queue_size=config.getint("ProxyPool", "fast_validate_queue_size"),
+        validate_targets=[ target.strip() for target in config.get("ProxyPool", "validate_targets").split(",") if target.strip() ],
+        crawl_connector_limit=config.getint("ProxyPool", "crawl_connector_limit"),
+        crawl_connector_limit_per_host=config.getint("ProxyPool", "crawl_connector_limit_per_host"),
+        crawl_keepalive_timeout=config.getint("ProxyPool", "crawl_keepalive_timeout"),
+        validate_connector_limit=config.getint("ProxyPool", "validate_connector_limit"),
+        validate_connector_limit_per_host=config.getint("ProxyPool", "validate_connector_limit_per_host"),
+        validate_keepalive_timeout=config.getint("ProxyPool", "validate_keepalive_timeout"),
+        dns_cache_ttl=config.getint("ProxyPool", "dns_cache_ttl"),
+        metrics_port=metrics_port,
+        metrics_interval_second=config.getint("ProxyPool", "metrics_interval_second"),
+        role=role,
+        consumer_name=consumer_name,
+        validate_stream_max_length=config.getint("ProxyPool", "validate_stream_max_length"),
+        validate_stream_reclaim_idle_second=config.getint("ProxyPool", "validate_stream_reclaim_idle_second"),
+        shard_count=shard_count,
+        shard=shard,
+        parse_process_count=config.getint("CrawlJobFactory", "parse_process_count"),
+        geoip_database=config.get("CrawlJobFactory", "geoip_database"),
         **crawl_job_page_count_dict
     )
     
     # 等待两个生产协程对应的 Task
     await proxy_pool.task_for_produce_crawl_validate_job
 
+# worker 进程入口
+def run_worker(args: argparse.Namespace, worker: int):
+    asyncio.run(main(args, worker))
+
+# 启动 worker 进程 退出的 worker 会被重新启动
+async def supervise_workers(args: argparse.Namespace, interval: float = 5):
+    context = multiprocessing.get_context("spawn")
+    process_list = [ None ] * args.workers
+    while True:
+        for worker, process in enumerate(process_list):
+            if process is not None and process.is_alive(): continue
+            if process is not None: logging.warning("worker {} 退出 exitcode {} 重新启动".format(worker, process.exitcode))
+            process_list[worker] = context.Process(target=run_worker, args=(args, worker), daemon=True)
+            process_list[worker].start()
+        await asyncio.sleep(interval)
+
+async def run(args: argparse.Namespace):
+    if args.workers <= 1:
+        await main(args)
+        return
+    role = args.role or read_config().get("ProxyPool", "role")
+    if role == "coordinator": raise ValueError("--workers 只能用于 standalone 或 validator")
+    # standalone 时主进程抓取并分配验证任务 validator 时主进程只管理 worker
+    if role == "standalone": await asyncio.gather(supervise_workers(args), main(args))
+    else: await supervise_workers(args)
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # 命令行参数 优先于配置文件
+    arg_parser = argparse.ArgumentParser(description="代理池")
+    arg_parser.add_argument("--role", choices=["standalone", "coordinator", "validator"], help="运行方式 默认为配置中的 role")
+    arg_parser.add_argument("--workers", type=int, default=1, help="验证进程数量 大于 1 时在多个进程中验证代理")
+    asyncio.run(run(arg_parser.parse_args()))
\ No newline at end of file
@@ -1,45 +1,139 @@
-from typing import List
+from typing import List, AsyncIterator
+import configparser, json, os
 
 import uvicorn
-from fastapi import FastAPI, Depends, Body
+from fastapi import FastAPI, Depends, Body, Query, HTTPException
+from starlette.responses import JSONResponse, StreamingResponse, Response
+from prometheus_client import CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
 
-from proxy.storage import ProxyPoolStorage
-from proxy.models import ProxyItem
+from proxy.storage import ProxyPoolStorage, AsyncProxyPoolStorage, close_async_redis_engine, PROXY_ACTIVE_MIN_SCORE
+from proxy.models import ProxyItem, ANONYMITY_LEVELS
+from proxy.cache import ProxySnapshot
+from proxy.metrics import POOL_SIZE
+
+# 读取配置 配置文件不存在时使用默认值
+config = configparser.ConfigParser()
+config.read(["./production/config/production.cfg"], encoding="UTF-8")
 
 app = FastAPI()
+# 异步 Redis 连接池与事件循环绑定 在启动时创建 每个 worker 进程一份
+storage: AsyncProxyPoolStorage = None
+snapshot: ProxySnapshot = None
+
+@app.on_event("startup")
+async def startup():
+    global storage, snapshot
+    storage = AsyncProxyPoolStorage()
+    snapshot = ProxySnapshot(
+        storage,
+        size=config.getint("WebAPI", "snapshot_size", fallback=100),
+        ttl=config.getfloat("WebAPI", "snapshot_ttl", fallback=10.0),
+        min_refresh_interval=config.getfloat("WebAPI", "snapshot_min_refresh_interval", fallback=1.0),
+    )
+    await snapshot.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await snapshot.stop()
+    await close_async_redis_engine()
 
 # Dependency
-def get_storage():
-    return ProxyPoolStorage()
+def get_storage() -> AsyncProxyPoolStorage:
+    return storage
 
 
+# 随机选择代理 范围在内存快照之内时不访问 Redis
 @app.get("/", response_model=ProxyItem)
-def get_default_random_proxy(storage: ProxyPoolStorage = Depends(get_storage)):
-    return storage.get()
+async def get_default_random_proxy():
+    return snapshot.get()
 
 @app.get("/random", response_model=ProxyItem)
-def get_random_proxy(random_range: int = 30, storage: ProxyPoolStorage = Depends(get_storage)):
-    return storage.get_range_random(random_range)
+async def get_random_proxy(
+    random_range: int = Query(30, ge=1), weighted: bool = False, https: bool = None, anonymity: str = None, country: str = None,
+    storage: AsyncProxyPoolStorage = Depends(get_storage)
+):
+    # 按属性过滤时 由属性索引在 Redis 中一次完成过滤与随机选择 此时 weighted 不生效 没有满足条件的代理时返回 404
+    if https is not None or anonymity is not None or country is not None:
+        if anonymity is not None and anonymity not in ANONYMITY_LEVELS:
+            raise HTTPException(status_code=400, detail="anonymity must be one of {}".format(", ".join(ANONYMITY_LEVELS)))
+        proxy = await storage.get_filtered_random(random_range, https, anonymity, country.upper() if country else None)
+        if proxy is None: raise HTTPException(status_code=404, detail="no proxy matches the filter")
+        return proxy
+    if snapshot.covers(random_range):
+        if weighted: return snapshot.get_weighted_random(random_range)
+        return snapshot.get_range_random(random_range)
+    if weighted: return await storage.get_weighted_random(random_range)
+    return await storage.get_range_random(random_range)
+
+@app.get("/fastest", response_model=List[ProxyItem])
+async def get_fastest_proxy(count: int = Query(10, ge=1, le=1000), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    return await storage.get_fastest(count)
+
+# 一次获取 n 个不同的代理 lease_ms 大于 0 时以 lease_token 租用 租约期间其他 /batch 请求不会返回这些代理
+@app.get("/batch", response_model=List[ProxyItem])
+async def get_batch_proxy(
+    n: int = Query(50, ge=1, le=1000), https: bool = None, min_score: float = PROXY_ACTIVE_MIN_SCORE,
+    lease_ms: int = Query(0, ge=0), lease_token: str = "", storage: AsyncProxyPoolStorage = Depends(get_storage)
+):
+    if lease_ms > 0 and lease_token == "":
+        raise HTTPException(status_code=400, detail="lease_token is required when lease_ms > 0")
+    return await storage.get_batch(n, https, min_score, lease_ms, lease_token)
+
+# 提前释放 lease_token 租用的代理
+@app.post("/release")
+async def release_proxy_items(lease_token: str, items: List[ProxyItem] = Body(...), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    released = await storage.release(items, lease_token)
+    return {"released": released}
 
 @app.get("/all", response_model=List[ProxyItem])
-def get_all(storage: ProxyPoolStorage = Depends(get_storage)):
-    return storage.get_all()
+async def get_all(storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    return await storage.get_all()
+
+# 分页获取全部代理 cursor 为 0 时从头开始 返回的 cursor 为 0 表示遍历结束
+# 数据来自 Storage 不经过 response_model 校验
+@app.get("/all/page")
+async def get_all_page(cursor: int = Query(0, ge=0), count: int = Query(500, ge=1, le=5000), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    cursor, proxy_list = await storage.get_page(cursor, count)
+    return JSONResponse({"cursor": cursor, "proxies": [ proxy.dict() for proxy in proxy_list ]})
+
+# 以 NDJSON 格式流式返回全部代理 每读取一页写出一次 每行一个代理
+@app.get("/all/stream")
+async def get_all_stream(batch_size: int = Query(500, ge=1, le=5000), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    async def iter_ndjson() -> AsyncIterator[str]:
+        cursor = 0
+        while True:
+            cursor, proxy_list = await storage.get_page(cursor, batch_size)
+            if len(proxy_list) > 0:
+                yield "".join( json.dumps(proxy.dict()) + "\n" for proxy in proxy_list )
+            if cursor == 0: break
+    return StreamingResponse(iter_ndjson(), media_type="application/x-ndjson")
 
 @app.post("/activate")
-def activate_proxy_item(item: ProxyItem = Body(...), storage: ProxyPoolStorage = Depends(get_storage)):
-    suc = storage.activate(item)
+async def activate_proxy_item(item: ProxyItem = Body(...), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    suc = await storage.activate(item)
     return {"state": suc}
 
 @app.post("/deactivate")
-def deactivate_proxy_item(item: ProxyItem = Body(...), storage: ProxyPoolStorage = Depends(get_storage)):
-    suc = storage.deactivate(item)
+async def deactivate_proxy_item(item: ProxyItem = Body(...), storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    suc = await storage.deactivate(item)
     return {"state": suc}
 
+# Prometheus 指标 设置环境变量 PROMETHEUS_MULTIPROC_DIR 时汇总全部 worker 进程的指标
+@app.get("/metrics")
+async def get_metrics(storage: AsyncProxyPoolStorage = Depends(get_storage)):
+    for band, count in (await storage.count_by_score_band()).items():
+        POOL_SIZE.labels(band).set(count)
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 
 if __name__ == "__main__":
-    storage = ProxyPoolStorage()
+    sync_storage = ProxyPoolStorage()
     for index in range(100):
-        storage.add(ProxyItem(
+        sync_storage.add(ProxyItem(
             ip="99.0.0.%s" % index,
             port=9999,
             https=False
@@ -0,0 +1,89 @@
+import asyncio, time, logging, random
+from typing import List, Optional, Tuple
+
+from .storage import AsyncProxyPoolStorage, choose_by_latency
+from .models import ProxyItem
+
+class ProxySnapshot:
+    '''
+    WebAPI 进程内 分数最高的 size 个代理的内存快照
+    后台协程每隔 poll_interval 秒读取代理池版本号 版本号变化且距上次刷新超过 min_refresh_interval 秒
+    或距上次刷新超过 ttl 秒时 重新加载快照 随机选择代理时不访问 Redis
+    '''
+    def __init__(
+        self,
+        storage: AsyncProxyPoolStorage,
+        *,
+        size = 100, # 快照中代理的数量
+        ttl = 10.0, # 快照最长有效时间 单位秒
+        min_refresh_interval = 1.0, # 两次刷新的最短间隔 单位秒 避免验证期间频繁刷新
+        poll_interval = 0.5, # 检查版本号的间隔 单位秒
+    ):
+        self.storage = storage
+        self.size = size
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.poll_interval = poll_interval
+        # (代理列表, 延迟列表) 刷新时整体替换 读取方无需加锁
+        self.snapshot: Tuple[List[ProxyItem], List[Optional[float]]] = (list(), list())
+        self.version = None
+        self.refreshed_at = 0.0
+        self._task: asyncio.Task = None
+
+    # 从 Redis 重新加载快照
+    async def refresh(self):
+        version = await self.storage.get_version()
+        self.snapshot = await self.storage.get_top_with_latency(self.size)
+        self.version, self.refreshed_at = version, time.monotonic()
+
+    # 根据版本号以及有效时间 判断是否需要刷新
+    async def refresh_if_stale(self):
+        elapsed = time.monotonic() - self.refreshed_at
+        if elapsed >= self.ttl or (elapsed >= self.min_refresh_interval and await self.storage.get_version() != self.version):
+            await self.refresh()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh_if_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("刷新代理快照异常: %s" % e)
+            await asyncio.sleep(self.poll_interval)
+
+    # 加载快照 并启动后台刷新协程 需要在事件循环中调用
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.error("加载代理快照异常: %s" % e)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None: return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    # 快照能否满足指定范围的请求 范围超过快照大小时需要访问 Redis
+    def covers(self, random_range: int) -> bool:
+        return random_range <= self.size
+
+    # 从指定范围中随机选择
+    def get_range_random(self, random_range: int = 30) -> ProxyItem:
+        proxy_list = self.snapshot[0][:random_range]
+        if len(proxy_list) == 0: return None
+        return random.choice(proxy_list)
+
+    # 获取前三十代理的随机一个 与 ProxyPoolStorage.get 一致 范围为前 31 个
+    def get(self) -> ProxyItem:
+        return self.get_range_random(31)
+
+    # 从指定范围中 以延迟的倒数为权重随机选择
+    def get_weighted_random(self, random_range: int = 30) -> ProxyItem:
+        proxy_list, latency_list = self.snapshot
+        return choose_by_latency(proxy_list[:random_range], latency_list[:random_range])
@@ -1,11 +1,45 @@
 from enum import Enum
-from typing import Callable, NoReturn
+from typing import Awaitable, Callable, NoReturn, Optional, Set
 from pydantic import BaseModel, Field
 
+# 代理的匿名度 transparent 透明 anonymous 普通匿名 elite 高匿
+ANONYMITY_LEVELS = ("transparent", "anonymous", "elite")
+
 class ProxyItem(BaseModel):
     ip: str
     port: int
     https: bool
+    anonymity: str = Field("") # 匿名度 取值见 ANONYMITY_LEVELS 空字符串表示未知
+    country: str = Field("") # 国家的 ISO 3166 代码 由 GeoIP 数据库得到 空字符串表示未知
+
+    # 代理在 Redis 中的规范化键 ip:port
+    @property
+    def key(self) -> str:
+        return "{}:{}".format(self.ip, self.port)
+
+    # 由规范化键构建 ProxyItem 数据来自 Storage 跳过 pydantic 校验
+    @classmethod
+    def from_key(cls, key: str, https: bool = False, anonymity: str = "", country: str = "") -> "ProxyItem":
+        ip, _, port = key.rpartition(":")
+        return cls.construct(ip=ip, port=int(port), https=https, anonymity=anonymity, country=country)
+
+# 网络请求失败的原因
+class FetchError(Enum):
+    NONE = "none"                           # 请求成功 状态码为 200
+    HTTP_STATUS = "http_status"             # 状态码不为 200
+    CONNECT_REFUSED = "connect_refused"     # 连接被拒绝
+    CONNECT_TIMEOUT = "connect_timeout"     # 建立连接超时
+    READ_TIMEOUT = "read_timeout"           # 建立连接后 读取响应超时
+    CONNECTION_ERROR = "connection_error"   # 其他连接错误 例如代理断开连接
+    OTHER = "other"                         # 其他异常
+
+# 一次网络请求的结果
+class FetchResult(BaseModel):
+    content: str = ""   # 响应内容 请求失败或状态码不为 200 时为空
+    status: Optional[int] = None # 响应状态码
+    error: FetchError = FetchError.NONE # 请求失败的原因
+    connect_time: Optional[float] = None # 建立连接耗时 单位秒 复用连接时为 None
+    total_time: Optional[float] = None # 请求总耗时 单位秒 请求失败时为 None
 
 # 任务类型
 class JobType(Enum):
@@ -20,16 +54,18 @@ class JobBase(BaseModel):
 class CrawlJob(JobBase):
     job_type: JobType = Field(JobType.CRAWL)
     target_url: str # 抓取的目标页面路径
-    # 回调函数 将 html 解析后 将代理添加到Storage中 
+    source: str = Field("") # 抓取源名称 用于按抓取源限速
+    # 回调协程函数 将 html 解析后 将代理添加到Storage中 
     # 参数 str 为抓取的页面 html 内容 返回值为插入到 storage 中代理的数量
-    callback: Callable[[str],int] 
+    callback: Callable[[str], Awaitable[int]]
     retry_count: int = Field(0) # 当前重试次数
+    failed_proxy_keys: Set[str] = Field(set()) # 抓取此页面失败过的代理 重试时不再使用
 
 # 描述验证任务
 class ValidateJob(JobBase):
     job_type: JobType = Field( JobType.VALIDATE )
     proxy_item: ProxyItem   # 被验证的代理
-    # 回调函数 验证响应数据的正确与否 判断是否激活数据库中的代理
-    # 参数 str 为验证的响应返回值 ProxyItem 为当前验证的代理对象
+    # 回调协程函数 验证响应数据的正确与否 判断是否激活数据库中的代理
+    # 参数 FetchResult 为验证请求的结果 包含响应内容以及耗时 ProxyItem 为当前验证的代理对象
     # 返回值为是否激活
-    callback: Callable[ [ str, ProxyItem ], bool ] 
\ No newline at end of file
+    callback: Callable[ [ FetchResult, ProxyItem ], Awaitable[bool] ] 
\ No newline at end of file
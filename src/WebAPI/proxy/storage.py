@@ -1,20 +1,477 @@
-import json, random, os
-from typing import List
+import json, random, os, time, zlib
+from collections import defaultdict
+from typing import List, Tuple, Dict, Optional
 
 import redis
+import redis.asyncio as aioredis
 
-from .models import ProxyItem
+from .models import ProxyItem, FetchResult, FetchError, ANONYMITY_LEVELS
+from .metrics import observe_redis_calls
 
 
-redis_engine = redis.Redis(host="redis" , port=6379) if os.getenv("PRODUCTION_ENV") else redis.Redis(host="127.0.0.1" , port=6379)
+REDIS_HOST = "redis" if os.getenv("PRODUCTION_ENV") else "127.0.0.1"
+REDIS_PORT = 6379
+REDIS_MAX_CONNECTIONS = 64 # 异步连接池最大连接数
+redis_engine = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# 有序集合 成员为代理的规范化键 ip:port 分数为代理的可用性
 REDIS_PROXY_KEY = "ProxyPool:ProxyItem:SSet" # 国内
 # zrange ProxyPool:ProxyItem:SSet 0 -1 withscores
 # REDIS_PROXY_KEY = "ProxyPool:ProxyItem:SSet:Foreign" # 国外
 # zrange ProxyPool:ProxyItem:SSet:Foreign 0 -1 withscores
+# 代理属性 Hash field 为代理的规范化键
+REDIS_PROXY_HTTPS_KEY = "ProxyPool:ProxyItem:Https" # 是否支持 https 值为 1/0
+REDIS_PROXY_CHECKED_AT_KEY = "ProxyPool:ProxyItem:CheckedAt" # 最近一次验证的时间戳
+REDIS_PROXY_CONNECT_LATENCY_KEY = "ProxyPool:ProxyItem:ConnectLatency" # 建立连接耗时的 EWMA 单位毫秒
+REDIS_PROXY_ANONYMITY_KEY = "ProxyPool:ProxyItem:Anonymity" # 匿名度 未知时没有此 field
+REDIS_PROXY_COUNTRY_KEY = "ProxyPool:ProxyItem:Country" # 国家的 ISO 3166 代码 未知时没有此 field
+# 属性索引 集合 成员为具有此属性值的代理的规范化键 键为 前缀 + 属性名:属性值
+# 例如 ProxyPool:ProxyItem:Index:https:1 ProxyPool:ProxyItem:Index:anonymity:elite ProxyPool:ProxyItem:Index:country:US
+REDIS_PROXY_INDEX_KEY_PREFIX = "ProxyPool:ProxyItem:Index:"
+# 有序集合 分数为验证请求总耗时的 EWMA 单位毫秒 用于选择最快的代理
+REDIS_PROXY_LATENCY_KEY = "ProxyPool:ProxyItem:Latency"
+# 代理池版本号 每次写入代理池时加一 WebAPI 据此判断内存快照是否过期
+REDIS_PROXY_VERSION_KEY = "ProxyPool:ProxyItem:Version"
+# 有序集合 分数为代理下一次验证的时间戳 验证器持续取出到期的代理
+REDIS_PROXY_DUE_KEY = "ProxyPool:ProxyItem:Due"
+# Hash 连续验证结果 正数为连续成功次数 负数为连续失败次数
+REDIS_PROXY_STREAK_KEY = "ProxyPool:ProxyItem:Streak"
+# Hash 验证成功率的 EWMA 取值 [0, 1] 成功记为 1 失败记为 0
+REDIS_PROXY_SUCCESS_RATE_KEY = "ProxyPool:ProxyItem:SuccessRate"
+# 代理租约 键为 前缀 + 代理的规范化键 值为客户端的租约标识 过期后自动释放
+REDIS_PROXY_LEASE_KEY_PREFIX = "ProxyPool:ProxyItem:Lease:"
+# 分布式验证 协调进程将到期的代理写入 Stream 验证进程以消费者组读取 确认后删除 消息的 field 为 key / https
+REDIS_VALIDATE_STREAM_KEY = "ProxyPool:ValidateStream"
+REDIS_VALIDATE_GROUP = "validators"
+# Hash 全部验证进程累计的验证数量 field 为 total / activated 协调进程定期取出并清零
+REDIS_VALIDATE_STATS_KEY = "ProxyPool:ValidateStats"
+# 多进程模式下 代理按 proxy_shard 分配给各验证进程 每个分片使用 Stream 以及统计的键加上 :分片序号
+
+# 代理初始分数 激活分数
+PROXY_INIT_SCORE = 20
+PROXY_ACTIVATED_SCORE = 100
+# 延迟与成功率对分数的影响 激活后的分数为
+# PROXY_ACTIVATED_SCORE - PROXY_LATENCY_PENALTY * min(延迟, PROXY_LATENCY_CAP_MS) / PROXY_LATENCY_CAP_MS - PROXY_SUCCESS_RATE_PENALTY * (1 - 成功率)
+# 即激活的代理分数在 [90, 100] 之间 越快 近期验证越稳定 分数越高 每次验证失败分数减一
+PROXY_LATENCY_ALPHA = 0.3 # EWMA 中最新一次测量的权重
+PROXY_LATENCY_PENALTY = 5
+PROXY_LATENCY_CAP_MS = 10000
+PROXY_SUCCESS_RATE_ALPHA = 0.2 # 成功率 EWMA 中最新一次验证结果的权重 约等于最近 10 次验证的成功率
+PROXY_SUCCESS_RATE_PENALTY = 5
+# 激活的代理的最低分数
+PROXY_ACTIVE_MIN_SCORE = PROXY_ACTIVATED_SCORE - PROXY_LATENCY_PENALTY - PROXY_SUCCESS_RATE_PENALTY
+# 下一次验证的间隔 单位秒 验证成功时间隔为 PROXY_RECHECK_BASE_SECONDS * 2 ^ (连续成功次数 - 1) 不超过 PROXY_RECHECK_MAX_SECONDS
+# 验证失败时 前 PROXY_RECHECK_FAIL_FAST_COUNT 次在 PROXY_RECHECK_FAIL_SECONDS 后重新验证 之后每次失败间隔加倍 不超过 PROXY_RECHECK_FAIL_MAX_SECONDS
+# 间隔带有 PROXY_RECHECK_JITTER 比例的随机抖动 避免验证集中在同一时刻
+PROXY_RECHECK_BASE_SECONDS = 300
+PROXY_RECHECK_MAX_SECONDS = 3600
+PROXY_RECHECK_FAIL_SECONDS = 60
+PROXY_RECHECK_FAIL_FAST_COUNT = 3
+PROXY_RECHECK_FAIL_MAX_SECONDS = 1800
+PROXY_RECHECK_JITTER = 0.1
+# 验证失败时扣除的分数 连接被拒绝说明代理已经不存在 直接删除
+PROXY_FAIL_PENALTY = 1
+PROXY_DROP_ERRORS = {FetchError.CONNECT_REFUSED}
+# 按属性过滤随机选择时 最小的属性索引集合不超过此数量 则以其成员作为候选代理 否则按分数从高到低逐个检查
+PROXY_INDEX_INTERSECT_MAX = 1000
+# 统计代理数量的分数区间 (名称, 最小分数, 最大分数) ZCOUNT 格式 active 为已激活 failing 为激活后验证失败 new 为未激活过
+PROXY_SCORE_BANDS = (
+    ("active", PROXY_ACTIVE_MIN_SCORE, "+inf"),
+    ("failing", "({}".format(PROXY_INIT_SCORE), "({}".format(PROXY_ACTIVE_MIN_SCORE)),
+    ("new", "-inf", PROXY_INIT_SCORE),
+)
+
+# Lua 脚本 在 Redis 服务端一次完成 检查 + 更新 避免多次往返以及与 WebAPI 之间的竞争
+# KEYS[1] 代理有序集合 KEYS[2] https Hash KEYS[3] 验证时间 Hash KEYS[4] 延迟有序集合 KEYS[5] 连接耗时 Hash KEYS[6] 版本号
+# KEYS[7] 下一次验证时间有序集合 KEYS[8] 连续验证结果 Hash KEYS[9] 匿名度 Hash KEYS[10] 国家 Hash KEYS[11] 成功率 Hash
+# ARGV[1] 代理键 ARGV[2] 激活分数 ARGV[3] 验证时间 ARGV[4] 总耗时 ARGV[5] 连接耗时 耗时为空字符串表示未测量
+# ARGV[6] EWMA 权重 ARGV[7] 延迟最多扣除的分数 ARGV[8] 延迟上限
+# ARGV[9] 验证间隔的初始值 ARGV[10] 验证间隔的上限 ARGV[11] 验证间隔的抖动系数
+# ARGV[12] 成功率 EWMA 权重 ARGV[13] 成功率最多扣除的分数 没有验证记录的代理成功率记为 1
+ACTIVATE_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local alpha = tonumber(ARGV[6])
+local latency = redis.call('ZSCORE', KEYS[4], ARGV[1])
+if latency then latency = tonumber(latency) end
+if ARGV[4] ~= '' then
+    local sample = tonumber(ARGV[4])
+    if latency then latency = alpha * sample + (1 - alpha) * latency else latency = sample end
+    redis.call('ZADD', KEYS[4], string.format('%.1f', latency), ARGV[1])
+end
+if ARGV[5] ~= '' then
+    local sample = tonumber(ARGV[5])
+    local connect_latency = redis.call('HGET', KEYS[5], ARGV[1])
+    if connect_latency then sample = alpha * sample + (1 - alpha) * tonumber(connect_latency) end
+    redis.call('HSET', KEYS[5], ARGV[1], string.format('%.1f', sample))
+end
+local penalty = 0
+if latency then
+    local cap = tonumber(ARGV[8])
+    penalty = tonumber(ARGV[7]) * math.min(latency, cap) / cap
+end
+local rate_alpha, rate = tonumber(ARGV[12]), redis.call('HGET', KEYS[11], ARGV[1])
+if rate then rate = rate_alpha + (1 - rate_alpha) * tonumber(rate) else rate = 1 end
+redis.call('HSET', KEYS[11], ARGV[1], string.format('%.4f', rate))
+penalty = penalty + tonumber(ARGV[13]) * (1 - rate)
+redis.call('ZADD', KEYS[1], string.format('%.3f', tonumber(ARGV[2]) - penalty), ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+local streak = math.max(tonumber(redis.call('HGET', KEYS[8], ARGV[1]) or 0), 0) + 1
+redis.call('HSET', KEYS[8], ARGV[1], streak)
+local interval = math.min(tonumber(ARGV[9]) * 2 ^ math.min(streak - 1, 16), tonumber(ARGV[10])) * tonumber(ARGV[11])
+redis.call('ZADD', KEYS[7], math.floor(tonumber(ARGV[3]) + interval), ARGV[1])
+redis.call('INCR', KEYS[6])
+return 1
+"""
+# KEYS 同上
+# ARGV[1] 代理键 ARGV[2] 验证时间 ARGV[3] 失败后的验证间隔 ARGV[4] 验证间隔的抖动系数 ARGV[5] 扣除的分数 ARGV[6] 属性索引键前缀
+# ARGV[7] 成功率 EWMA 权重 ARGV[8] 以 ARGV[3] 为间隔重新验证的连续失败次数 ARGV[9] 失败后验证间隔的上限
+# 分数降为 0 时删除代理及其属性 并从属性索引中移除
+DEACTIVATE_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local score = tonumber(redis.call('ZINCRBY', KEYS[1], -tonumber(ARGV[5]), ARGV[1]))
+if score <= 0 then
+    for _, attribute in ipairs({{'https', KEYS[2]}, {'anonymity', KEYS[9]}, {'country', KEYS[10]}}) do
+        local value = redis.call('HGET', attribute[2], ARGV[1])
+        if value then redis.call('SREM', ARGV[6] .. attribute[1] .. ':' .. value, ARGV[1]) end
+    end
+    redis.call('HDEL', KEYS[9], ARGV[1])
+    redis.call('HDEL', KEYS[10], ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    redis.call('HDEL', KEYS[5], ARGV[1])
+    redis.call('ZREM', KEYS[7], ARGV[1])
+    redis.call('HDEL', KEYS[8], ARGV[1])
+    redis.call('HDEL', KEYS[11], ARGV[1])
+else
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+    local rate = tonumber(redis.call('HGET', KEYS[11], ARGV[1]) or 1) * (1 - tonumber(ARGV[7]))
+    redis.call('HSET', KEYS[11], ARGV[1], string.format('%.4f', rate))
+    local streak = math.min(tonumber(redis.call('HGET', KEYS[8], ARGV[1]) or 0), 0) - 1
+    redis.call('HSET', KEYS[8], ARGV[1], streak)
+    local backoff = math.min(math.max(-streak - tonumber(ARGV[8]), 0), 16)
+    local interval = math.min(tonumber(ARGV[3]) * 2 ^ backoff, tonumber(ARGV[9])) * tonumber(ARGV[4])
+    redis.call('ZADD', KEYS[7], math.floor(tonumber(ARGV[2]) + interval), ARGV[1])
+end
+redis.call('INCR', KEYS[6])
+return 1
+"""
+PROXY_KEYS = [
+    REDIS_PROXY_KEY, REDIS_PROXY_HTTPS_KEY, REDIS_PROXY_CHECKED_AT_KEY,
+    REDIS_PROXY_LATENCY_KEY, REDIS_PROXY_CONNECT_LATENCY_KEY, REDIS_PROXY_VERSION_KEY,
+    REDIS_PROXY_DUE_KEY, REDIS_PROXY_STREAK_KEY, REDIS_PROXY_ANONYMITY_KEY, REDIS_PROXY_COUNTRY_KEY,
+    REDIS_PROXY_SUCCESS_RATE_KEY
+]
+
+# 取出最多 ARGV[2] 个下一次验证时间不晚于 ARGV[1] 的代理 并将其下一次验证时间推迟 ARGV[3] 秒
+# 避免验证期间被重复取出 验证结果写入后会重新设置下一次验证时间 已不在代理池中的代理直接删除
+# KEYS[1] 下一次验证时间有序集合 KEYS[2] 代理有序集合 KEYS[3] https Hash
+# 返回 [代理键, https, ...]
+CLAIM_DUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local result = {}
+for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))) do
+    if redis.call('ZSCORE', KEYS[2], key) then
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), key)
+        table.insert(result, key)
+        table.insert(result, redis.call('HGET', KEYS[3], key) or '0')
+    else
+        redis.call('ZREM', KEYS[1], key)
+    end
+end
+return result
+"""
+PROXY_DUE_KEYS = [REDIS_PROXY_DUE_KEY, REDIS_PROXY_KEY, REDIS_PROXY_HTTPS_KEY]
+
+# 按延迟从低到高 返回分数不低于 ARGV[2] 的前 ARGV[1] 个代理
+# KEYS[1] 代理有序集合 KEYS[2] https Hash KEYS[3] 延迟有序集合 KEYS[4] 匿名度 Hash KEYS[5] 国家 Hash
+# 返回 [代理键, https, 匿名度, 国家, ...]
+FASTEST_SCRIPT = """
+local count, min_score = tonumber(ARGV[1]), tonumber(ARGV[2])
+local result, start, chunk = {}, 0, 200
+while #result < count * 4 do
+    local key_list = redis.call('ZRANGE', KEYS[3], start, start + chunk - 1)
+    if #key_list == 0 then break end
+    for _, key in ipairs(key_list) do
+        local score = redis.call('ZSCORE', KEYS[1], key)
+        if score and tonumber(score) >= min_score then
+            table.insert(result, key)
+            table.insert(result, redis.call('HGET', KEYS[2], key) or '0')
+            table.insert(result, redis.call('HGET', KEYS[4], key) or '')
+            table.insert(result, redis.call('HGET', KEYS[5], key) or '')
+            if #result >= count * 4 then break end
+        end
+    end
+    start = start + chunk
+end
+return result
+"""
+# 返回分数最高的 ARGV[1] 个代理以及各自的延迟 KEYS 同上
+# 返回 [代理键, https, 匿名度, 国家, 延迟 未测量时为空字符串, ...]
+TOP_WITH_LATENCY_SCRIPT = """
+local result = {}
+for _, key in ipairs(redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)) do
+    table.insert(result, key)
+    table.insert(result, redis.call('HGET', KEYS[2], key) or '0')
+    table.insert(result, redis.call('HGET', KEYS[4], key) or '')
+    table.insert(result, redis.call('HGET', KEYS[5], key) or '')
+    table.insert(result, redis.call('ZSCORE', KEYS[3], key) or '')
+end
+return result
+"""
+PROXY_READ_KEYS = [
+    REDIS_PROXY_KEY, REDIS_PROXY_HTTPS_KEY, REDIS_PROXY_LATENCY_KEY, REDIS_PROXY_ANONYMITY_KEY, REDIS_PROXY_COUNTRY_KEY
+]
+
+# 按分数从高到低 返回 ARGV[1] 个分数不低于 ARGV[2] 且未被租用的不同代理 KEYS 同上
+# ARGV[3] https 过滤 空字符串表示不过滤 ARGV[4] 租约键前缀 ARGV[5] 租约时长 单位毫秒 0 表示不租用 ARGV[6] 租约标识
+# 租用时以 SET NX PX 占用代理 其他客户端的批量获取会略过已租用的代理
+# 返回 [代理键, https, 匿名度, 国家, ...]
+BATCH_SCRIPT = """
+local count, min_score, https_filter = tonumber(ARGV[1]), ARGV[2], ARGV[3]
+local prefix, lease_ms, token = ARGV[4], tonumber(ARGV[5]), ARGV[6]
+local result, offset, chunk = {}, 0, 200
+while #result < count * 4 do
+    local key_list = redis.call('ZREVRANGEBYSCORE', KEYS[1], '+inf', min_score, 'LIMIT', offset, chunk)
+    if #key_list == 0 then break end
+    for _, key in ipairs(key_list) do
+        local https = redis.call('HGET', KEYS[2], key) or '0'
+        if https_filter == '' or https == https_filter then
+            local free
+            if lease_ms > 0 then free = redis.call('SET', prefix .. key, token, 'NX', 'PX', lease_ms)
+            else free = redis.call('EXISTS', prefix .. key) == 0 end
+            if free then
+                table.insert(result, key)
+                table.insert(result, https)
+                table.insert(result, redis.call('HGET', KEYS[4], key) or '')
+                table.insert(result, redis.call('HGET', KEYS[5], key) or '')
+                if #result >= count * 4 then break end
+            end
+        end
+    end
+    offset = offset + chunk
+end
+return result
+"""
+# 在同时属于 KEYS[5...] 全部属性索引集合 且分数不低于 ARGV[2] 的代理中 按分数从高到低取前 ARGV[1] 个 从中随机选择一个
+# KEYS[1] 代理有序集合 KEYS[2] https Hash KEYS[3] 匿名度 Hash KEYS[4] 国家 Hash
+# ARGV[3] 最小的索引集合不超过此数量时 以其成员作为候选代理 否则按分数从高到低逐个检查是否属于全部索引集合
+# ARGV[4] [0, 1) 之间的随机数 用于随机选择
+# 返回 [代理键, https, 匿名度, 国家] 没有满足条件的代理时返回空列表
+FILTERED_RANDOM_SCRIPT = """
+local random_range, min_score, intersect_max = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3])
+local smallest, smallest_count
+for index = 5, #KEYS do
+    local count = redis.call('SCARD', KEYS[index])
+    if count == 0 then return {} end
+    if not smallest_count or count < smallest_count then smallest, smallest_count = index, count end
+end
+local function in_all_indexes(key)
+    for index = 5, #KEYS do
+        if index ~= smallest and redis.call('SISMEMBER', KEYS[index], key) == 0 then return false end
+    end
+    return true
+end
+local matched = {}
+if smallest_count and smallest_count <= intersect_max then
+    local min_score_number = tonumber(min_score) or -math.huge
+    local scored = {}
+    for _, key in ipairs(redis.call('SMEMBERS', KEYS[smallest])) do
+        local score = redis.call('ZSCORE', KEYS[1], key)
+        if score and tonumber(score) >= min_score_number and in_all_indexes(key) then
+            table.insert(scored, {key, tonumber(score)})
+        end
+    end
+    table.sort(scored, function(a, b) return a[2] > b[2] end)
+    for index = 1, math.min(#scored, random_range) do table.insert(matched, scored[index][1]) end
+else
+    local offset, chunk = 0, 200
+    while #matched < random_range do
+        local key_list = redis.call('ZREVRANGEBYSCORE', KEYS[1], '+inf', min_score, 'LIMIT', offset, chunk)
+        if #key_list == 0 then break end
+        for _, key in ipairs(key_list) do
+            if in_all_indexes(key) then
+                table.insert(matched, key)
+                if #matched >= random_range then break end
+            end
+        end
+        offset = offset + chunk
+    end
+end
+if #matched == 0 then return {} end
+local key = matched[math.floor(tonumber(ARGV[4]) * #matched) + 1]
+return {
+    key, redis.call('HGET', KEYS[2], key) or '0',
+    redis.call('HGET', KEYS[3], key) or '', redis.call('HGET', KEYS[4], key) or ''
+}
+"""
+PROXY_ATTRIBUTE_KEYS = [REDIS_PROXY_KEY, REDIS_PROXY_HTTPS_KEY, REDIS_PROXY_ANONYMITY_KEY, REDIS_PROXY_COUNTRY_KEY]
+
+# 释放租约 只删除标识与 ARGV[2] 相同的租约 ARGV[1] 租约键前缀 ARGV[3...] 代理键
+# 返回释放的数量
+RELEASE_SCRIPT = """
+local released = 0
+for index = 3, #ARGV do
+    local lease_key = ARGV[1] .. ARGV[index]
+    if redis.call('GET', lease_key) == ARGV[2] then
+        redis.call('DEL', lease_key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+# 异步 Redis 客户端 连接池内部的 Lock/Queue 与事件循环绑定 必须在事件循环中创建
+_async_redis_engine: aioredis.Redis = None
+def get_async_redis_engine() -> aioredis.Redis:
+    global _async_redis_engine
+    if _async_redis_engine is None:
+        _async_redis_engine = aioredis.Redis(
+            connection_pool=aioredis.BlockingConnectionPool(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                decode_responses=True
+            )
+        )
+    return _async_redis_engine
+
+# 关闭异步 Redis 客户端的连接池 之后再次调用 get_async_redis_engine 会重新创建
+async def close_async_redis_engine():
+    global _async_redis_engine
+    if _async_redis_engine is not None:
+        await _async_redis_engine.close()
+        await _async_redis_engine.connection_pool.disconnect()
+        _async_redis_engine = None
+
+# 代理所属的分片 由代理的规范化键决定 与进程无关
+def proxy_shard(proxy_key: str, shard_count: int) -> int:
+    return zlib.crc32(proxy_key.encode()) % shard_count
+
+# 验证 Stream 以及统计的键 shard 为 None 时为所有验证进程共用的键
+def validate_stream_key(shard: int = None) -> str:
+    return REDIS_VALIDATE_STREAM_KEY if shard is None else "{}:{}".format(REDIS_VALIDATE_STREAM_KEY, shard)
+
+def validate_stats_key(shard: int = None) -> str:
+    return REDIS_VALIDATE_STATS_KEY if shard is None else "{}:{}".format(REDIS_VALIDATE_STATS_KEY, shard)
+
+# 将验证 Stream 中的消息 转换为 (消息 id, ProxyItem) 列表 已删除的消息没有内容 略过
+def to_stream_entries(message_list: List[Tuple[str, Dict[str, str]]]) -> List[Tuple[str, ProxyItem]]:
+    return [ (message_id, ProxyItem.from_key(fields["key"], fields.get("https") == "1")) for message_id, fields in message_list if fields ]
+
+# 将代理键列表 与 对应的 https 标志 组合为 ProxyItem 列表 匿名度与国家列表为 None 时不填充这两个属性
+def to_proxy_items(
+    keys: List[str], https_flags: List[str],
+    anonymity_list: List[Optional[str]] = None, country_list: List[Optional[str]] = None
+) -> List[ProxyItem]:
+    if anonymity_list is None: anonymity_list = [None] * len(keys)
+    if country_list is None: country_list = [None] * len(keys)
+    return [
+        ProxyItem.from_key(key, https == "1", anonymity or "", country or "")
+        for key, https, anonymity, country in zip(keys, https_flags, anonymity_list, country_list)
+    ]
+
+# 属性索引集合的键 属性名为 https / anonymity / country
+def proxy_index_key(attribute: str, value) -> str:
+    return "{}{}:{}".format(REDIS_PROXY_INDEX_KEY_PREFIX, attribute, value)
+
+# 在 pipeline 中加入写入代理属性以及属性索引的命令 同一个索引的成员以一条 SADD 写入
+# 未知的匿名度与国家不覆盖已有的值 https 与匿名度改变时 从原属性值的索引中移除 代理的国家不会改变
+def queue_attribute_writes(pipe, proxy_list: List[ProxyItem]):
+    index_members: Dict[str, List[str]] = defaultdict(list)
+    stale_members: Dict[str, List[str]] = defaultdict(list)
+    for proxy in proxy_list:
+        index_members[proxy_index_key("https", int(proxy.https))].append(proxy.key)
+        stale_members[proxy_index_key("https", int(not proxy.https))].append(proxy.key)
+        if proxy.anonymity:
+            index_members[proxy_index_key("anonymity", proxy.anonymity)].append(proxy.key)
+            for level in ANONYMITY_LEVELS:
+                if level != proxy.anonymity: stale_members[proxy_index_key("anonymity", level)].append(proxy.key)
+        if proxy.country:
+            index_members[proxy_index_key("country", proxy.country)].append(proxy.key)
+    pipe.hset(REDIS_PROXY_HTTPS_KEY, mapping={ proxy.key: int(proxy.https) for proxy in proxy_list })
+    anonymity_mapping = { proxy.key: proxy.anonymity for proxy in proxy_list if proxy.anonymity }
+    if anonymity_mapping: pipe.hset(REDIS_PROXY_ANONYMITY_KEY, mapping=anonymity_mapping)
+    country_mapping = { proxy.key: proxy.country for proxy in proxy_list if proxy.country }
+    if country_mapping: pipe.hset(REDIS_PROXY_COUNTRY_KEY, mapping=country_mapping)
+    for index_key, key_list in stale_members.items():
+        pipe.srem(index_key, *key_list)
+    for index_key, key_list in index_members.items():
+        pipe.sadd(index_key, *key_list)
+
+# 按属性过滤随机选择的脚本参数 属性为 None 时不过滤 返回 (KEYS, ARGV)
+def filtered_random_args(
+    random_range: int, https: Optional[bool], anonymity: Optional[str], country: Optional[str], min_score
+) -> Tuple[List[str], list]:
+    index_keys: List[str] = list()
+    if https is not None: index_keys.append(proxy_index_key("https", int(https)))
+    if anonymity is not None: index_keys.append(proxy_index_key("anonymity", anonymity))
+    if country is not None: index_keys.append(proxy_index_key("country", country))
+    return PROXY_ATTRIBUTE_KEYS + index_keys, [random_range, min_score, PROXY_INDEX_INTERSECT_MAX, random.random()]
+
+# 将过滤随机选择脚本的返回值转换为 ProxyItem 没有满足条件的代理时为 None
+def to_filtered_proxy(result: List[str]) -> Optional[ProxyItem]:
+    if len(result) == 0: return None
+    key, https, anonymity, country = result
+    return ProxyItem.from_key(key, https == "1", anonymity, country)
+
+# 将耗时转换为脚本参数 单位秒转换为毫秒 None 表示未测量
+def _latency_arg(latency: Optional[float]):
+    return "" if latency is None else round(latency * 1000, 1)
+
+# 激活脚本的参数 latency connect_latency 单位为秒
+def activate_args(proxy: ProxyItem, checked_at: int, latency: float = None, connect_latency: float = None) -> list:
+    return [
+        proxy.key, PROXY_ACTIVATED_SCORE, checked_at, _latency_arg(latency), _latency_arg(connect_latency),
+        PROXY_LATENCY_ALPHA, PROXY_LATENCY_PENALTY, PROXY_LATENCY_CAP_MS,
+        PROXY_RECHECK_BASE_SECONDS, PROXY_RECHECK_MAX_SECONDS, _recheck_jitter(),
+        PROXY_SUCCESS_RATE_ALPHA, PROXY_SUCCESS_RATE_PENALTY
+    ]
+
+# 降权脚本的参数 drop 为 True 时扣除全部分数 直接删除代理
+def deactivate_args(proxy: ProxyItem, checked_at: int, drop: bool = False) -> list:
+    penalty = PROXY_ACTIVATED_SCORE if drop else PROXY_FAIL_PENALTY
+    return [
+        proxy.key, checked_at, PROXY_RECHECK_FAIL_SECONDS, _recheck_jitter(), penalty, REDIS_PROXY_INDEX_KEY_PREFIX,
+        PROXY_SUCCESS_RATE_ALPHA, PROXY_RECHECK_FAIL_FAST_COUNT, PROXY_RECHECK_FAIL_MAX_SECONDS
+    ]
+
+# 验证间隔的随机抖动系数
+def _recheck_jitter() -> float:
+    return round(random.uniform(1 - PROXY_RECHECK_JITTER, 1 + PROXY_RECHECK_JITTER), 3)
+
+# 将 [代理键, https, 匿名度, 国家, ...] 转换为 ProxyItem 列表
+def to_attributed_proxy_items(flat_list: List[str]) -> List[ProxyItem]:
+    return to_proxy_items(flat_list[0::4], flat_list[1::4], flat_list[2::4], flat_list[3::4])
+
+# 将 [代理键, https, 匿名度, 国家, 延迟, ...] 转换为 代理列表 以及对应的延迟列表 延迟未测量时为 None
+def to_proxy_latency_lists(flat_list: List[str]) -> Tuple[List[ProxyItem], List[Optional[float]]]:
+    proxy_list = to_proxy_items(flat_list[0::5], flat_list[1::5], flat_list[2::5], flat_list[3::5])
+    latency_list = [ float(latency) if latency != "" else None for latency in flat_list[4::5] ]
+    return proxy_list, latency_list
+
+# 批量获取脚本的参数 https 为 None 时不过滤
+def batch_args(count: int, https: Optional[bool], min_score: float, lease_ms: int, lease_token: str) -> list:
+    return [count, min_score, "" if https is None else int(https), REDIS_PROXY_LEASE_KEY_PREFIX, lease_ms, lease_token]
+
+# 以延迟的倒数为权重随机选择一个代理 未测量延迟的代理按延迟上限计算
+def choose_by_latency(proxy_list: List[ProxyItem], latency_list: List[Optional[float]]) -> ProxyItem:
+    if len(proxy_list) == 0: return None
+    weight_list = [ 1 / max(latency if latency is not None else PROXY_LATENCY_CAP_MS, 1) for latency in latency_list ]
+    return random.choices(proxy_list, weights=weight_list)[0]
+
 class ProxyPoolStorage:
     '''
     操作 Redis 进行 Proxy 的存储和排序
     '''
+    def __init__(self):
+        self.activate_script = redis_engine.register_script(ACTIVATE_SCRIPT)
+        self.deactivate_script = redis_engine.register_script(DEACTIVATE_SCRIPT)
+
     # 获取前三十代理的随机一个
     def get(self) -> ProxyItem:
         proxy_list = self.get_top_30()
@@ -23,52 +480,314 @@ class ProxyPoolStorage:
 
     # 从指定范围中随机选择
     def get_range_random(self, random_range: int = 30):
-        proxy_json_list = redis_engine.zrevrange(REDIS_PROXY_KEY, 0, random_range - 1)
-        if len(proxy_json_list) == 0: return None
+        key_list = redis_engine.zrevrange(REDIS_PROXY_KEY, 0, random_range - 1)
+        if len(key_list) == 0: return None
         else:
-            json_repr = proxy_json_list[random.randint(0, len(proxy_json_list) - 1)]
-            return ProxyItem(**json.loads(json_repr))
+            key = key_list[random.randint(0, len(key_list) - 1)]
+            pipe = redis_engine.pipeline(transaction=False)
+            for attribute_key in PROXY_ATTRIBUTE_KEYS[1:]:
+                pipe.hget(attribute_key, key)
+            return to_proxy_items([key], *[ [value] for value in pipe.execute() ])[0]
 
     # 获取前三十全部
     def get_top_30(self) -> List[ProxyItem]:
-        json_repr_list = redis_engine.zrevrange(REDIS_PROXY_KEY, 0, 30)
-        proxy_list = [ ProxyItem(**json.loads(json_repr)) for json_repr in json_repr_list ]
-        return proxy_list
+        key_list = redis_engine.zrevrange(REDIS_PROXY_KEY, 0, 30)
+        if len(key_list) == 0: return []
+        pipe = redis_engine.pipeline(transaction=False)
+        for attribute_key in PROXY_ATTRIBUTE_KEYS[1:]:
+            pipe.hmget(attribute_key, key_list)
+        return to_proxy_items(key_list, *pipe.execute())
 
     # 获取全部
     def get_all(self) -> List[ProxyItem]:
-        json_repr_list = redis_engine.zrange(REDIS_PROXY_KEY, 0, -1)
-        proxy_list = [ ProxyItem(**json.loads(json_repr)) for json_repr in json_repr_list ]
-        return proxy_list
+        pipe = redis_engine.pipeline(transaction=False)
+        pipe.zrange(REDIS_PROXY_KEY, 0, -1)
+        for attribute_key in PROXY_ATTRIBUTE_KEYS[1:]:
+            pipe.hgetall(attribute_key)
+        key_list, *attribute_dicts = pipe.execute()
+        return to_proxy_items(key_list, *[ [ attribute_dict.get(key) for key in key_list ] for attribute_dict in attribute_dicts ])
 
-    # 添加
+    # 添加 ZADD NX 与属性及属性索引的写入放在同一个事务中 一次往返
     def add(self, proxy: ProxyItem) -> bool:
-        if not self.exist(proxy):
-            json_repr = json.dumps(proxy.dict())
-            redis_engine.zadd(REDIS_PROXY_KEY, {json_repr: 20})
-            return True
-        return False
+        pipe = redis_engine.pipeline()
+        pipe.zadd(REDIS_PROXY_KEY, {proxy.key: PROXY_INIT_SCORE}, nx=True)
+        queue_attribute_writes(pipe, [proxy])
+        pipe.zadd(REDIS_PROXY_DUE_KEY, {proxy.key: int(time.time())}, nx=True)
+        pipe.incr(REDIS_PROXY_VERSION_KEY)
+        return pipe.execute()[0] == 1
 
     # 判断代理池中是否存在指定代理
     def exist(self, proxy: ProxyItem) -> bool:
-        return redis_engine.zrank(REDIS_PROXY_KEY, proxy.json()) is not None
+        return redis_engine.zscore(REDIS_PROXY_KEY, proxy.key) is not None
+
+    # 经过验证 proxy 可用 latency connect_latency 为本次验证的耗时 单位秒
+    def activate(self, proxy: ProxyItem, latency: float = None, connect_latency: float = None) -> bool:
+        return self.activate_script(keys=PROXY_KEYS, args=activate_args(proxy, int(time.time()), latency, connect_latency)) == 1
+
+    # 经过验证 proxy 不可用
+    def deactivate(self, proxy: ProxyItem) -> bool:
+        return self.deactivate_script(keys=PROXY_KEYS, args=deactivate_args(proxy, int(time.time()))) == 1
+
+
+@observe_redis_calls
+class AsyncProxyPoolStorage:
+    '''
+    ProxyPoolStorage 的异步版本 ProxyPool 的事件循环与 WebAPI 的各 worker 进程均通过此类访问 Redis 避免 Redis 请求阻塞事件循环
+    须在事件循环中创建 WebAPI 在 startup 事件中创建 每个 worker 进程一份
+    公开的协程方法的耗时记录在 metrics.REDIS_LATENCY 中
+    '''
+    def __init__(self):
+        self.redis = get_async_redis_engine()
+        self.activate_script = self.redis.register_script(ACTIVATE_SCRIPT)
+        self.deactivate_script = self.redis.register_script(DEACTIVATE_SCRIPT)
+        self.fastest_script = self.redis.register_script(FASTEST_SCRIPT)
+        self.top_with_latency_script = self.redis.register_script(TOP_WITH_LATENCY_SCRIPT)
+        self.batch_script = self.redis.register_script(BATCH_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+        self.claim_due_script = self.redis.register_script(CLAIM_DUE_SCRIPT)
+        self.filtered_random_script = self.redis.register_script(FILTERED_RANDOM_SCRIPT)
+
+    # 获取前三十代理的随机一个
+    async def get(self) -> ProxyItem:
+        proxy_list = await self.get_top_30()
+        if len(proxy_list) == 0: return None
+        else: return proxy_list[random.randint(0, len(proxy_list) - 1)]
+
+    # 从指定范围中随机选择
+    async def get_range_random(self, random_range: int = 30):
+        key_list = await self.redis.zrevrange(REDIS_PROXY_KEY, 0, random_range - 1)
+        if len(key_list) == 0: return None
+        else:
+            return (await self.get_attributed([key_list[random.randint(0, len(key_list) - 1)]]))[0]
+
+    # 从指定范围中 以延迟的倒数为权重随机选择 越快的代理被选中的概率越高
+    async def get_weighted_random(self, random_range: int = 30) -> ProxyItem:
+        return choose_by_latency(*await self.get_top_with_latency(random_range))
+
+    # 在满足属性条件的代理中 从分数最高的 random_range 个中随机选择 属性为 None 时不过滤 一次往返
+    async def get_filtered_random(
+        self, random_range: int = 30, https: bool = None, anonymity: str = None, country: str = None,
+        min_score: float = float("-inf")
+    ) -> Optional[ProxyItem]:
+        keys, args = filtered_random_args(random_range, https, anonymity, country, min_score)
+        return to_filtered_proxy(await self.filtered_random_script(keys=keys, args=args))
+
+    # 获取分数最高的 count 个代理 以及各自的延迟 一次往返
+    async def get_top_with_latency(self, count: int) -> Tuple[List[ProxyItem], List[Optional[float]]]:
+        return to_proxy_latency_lists(await self.top_with_latency_script(keys=PROXY_READ_KEYS, args=[count]))
+
+    # 代理池版本号
+    async def get_version(self) -> int:
+        return int(await self.redis.get(REDIS_PROXY_VERSION_KEY) or 0)
+
+    # 获取延迟最低的 count 个已激活的代理
+    async def get_fastest(self, count: int = 10, min_score: float = PROXY_ACTIVE_MIN_SCORE) -> List[ProxyItem]:
+        return to_attributed_proxy_items(await self.fastest_script(keys=PROXY_READ_KEYS, args=[count, min_score]))
+
+    # 一次往返获取 count 个不同的代理 lease_ms 大于 0 时以 lease_token 租用返回的代理
+    async def get_batch(
+        self, count: int, https: bool = None, min_score: float = PROXY_ACTIVE_MIN_SCORE,
+        lease_ms: int = 0, lease_token: str = ""
+    ) -> List[ProxyItem]:
+        return to_attributed_proxy_items(await self.batch_script(keys=PROXY_READ_KEYS, args=batch_args(count, https, min_score, lease_ms, lease_token)))
+
+    # 取出最多 count 个到期需要验证的代理 取出的代理 claim_timeout 秒内不会被再次取出
+    async def claim_due(self, count: int, claim_timeout: int) -> List[ProxyItem]:
+        flat_list = await self.claim_due_script(keys=PROXY_DUE_KEYS, args=[int(time.time()), count, claim_timeout])
+        return to_proxy_items(flat_list[0::2], flat_list[1::2])
+
+    # 释放 lease_token 租用的代理 返回释放的数量
+    async def release(self, proxy_list: List[ProxyItem], lease_token: str) -> int:
+        if len(proxy_list) == 0: return 0
+        return await self.release_script(args=[REDIS_PROXY_LEASE_KEY_PREFIX, lease_token] + [proxy.key for proxy in proxy_list])
+
+    # 获取前三十全部
+    async def get_top_30(self) -> List[ProxyItem]:
+        key_list = await self.redis.zrevrange(REDIS_PROXY_KEY, 0, 30)
+        if len(key_list) == 0: return []
+        return await self.get_attributed(key_list)
+
+    # 读取代理键对应的属性 组合为 ProxyItem 列表 一次往返
+    async def get_attributed(self, key_list: List[str]) -> List[ProxyItem]:
+        pipe = self.redis.pipeline(transaction=False)
+        for attribute_key in PROXY_ATTRIBUTE_KEYS[1:]:
+            pipe.hmget(attribute_key, key_list)
+        return to_proxy_items(key_list, *await pipe.execute())
+
+    # 获取全部
+    async def get_all(self) -> List[ProxyItem]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrange(REDIS_PROXY_KEY, 0, -1)
+        for attribute_key in PROXY_ATTRIBUTE_KEYS[1:]:
+            pipe.hgetall(attribute_key)
+        key_list, *attribute_dicts = await pipe.execute()
+        return to_proxy_items(key_list, *[ [ attribute_dict.get(key) for key in key_list ] for attribute_dict in attribute_dicts ])
 
-    # 经过验证 proxy 可用
-    def activate(self, proxy: ProxyItem) -> bool:
-        if self.exist(proxy):
-            json_repr = json.dumps(proxy.dict())
-            redis_engine.zadd(REDIS_PROXY_KEY, {json_repr: 100})
-            return True
-        else: return False
+    # 以 ZSCAN 获取一页代理 cursor 为 0 时从头开始 返回 (下一页的 cursor, 代理列表) 下一页的 cursor 为 0 表示遍历结束
+    # count 只是每页数量的提示 实际数量可能多于或少于 count 甚至为空
+    async def get_page(self, cursor: int = 0, count: int = 500) -> Tuple[int, List[ProxyItem]]:
+        cursor, member_score_list = await self.redis.zscan(REDIS_PROXY_KEY, cursor, count=count)
+        key_list = [ key for key, _ in member_score_list ]
+        if len(key_list) == 0: return cursor, []
+        return cursor, await self.get_attributed(key_list)
+
+    # 各分数区间的代理数量 区间见 PROXY_SCORE_BANDS
+    async def count_by_score_band(self) -> Dict[str, int]:
+        pipe = self.redis.pipeline(transaction=False)
+        for _, min_score, max_score in PROXY_SCORE_BANDS:
+            pipe.zcount(REDIS_PROXY_KEY, min_score, max_score)
+        return { band[0]: count for band, count in zip(PROXY_SCORE_BANDS, await pipe.execute()) }
+
+    # 添加 ZADD NX 与属性及属性索引的写入放在同一个事务中 一次往返
+    async def add(self, proxy: ProxyItem) -> bool:
+        pipe = self.redis.pipeline()
+        pipe.zadd(REDIS_PROXY_KEY, {proxy.key: PROXY_INIT_SCORE}, nx=True)
+        queue_attribute_writes(pipe, [proxy])
+        pipe.zadd(REDIS_PROXY_DUE_KEY, {proxy.key: int(time.time())}, nx=True)
+        pipe.incr(REDIS_PROXY_VERSION_KEY)
+        return (await pipe.execute())[0] == 1
+
+    # 批量添加 每个代理一条 ZADD NX 与属性及属性索引的写入放在同一个事务中 一次往返 返回新加入代理池的代理
+    # 新代理在 due_delay 秒后到期验证 已在代理池中的代理不改变下一次验证时间
+    async def add_many(self, proxy_list: List[ProxyItem], due_delay: int = 0) -> List[ProxyItem]:
+        if len(proxy_list) == 0: return []
+        pipe = self.redis.pipeline()
+        for proxy in proxy_list:
+            pipe.zadd(REDIS_PROXY_KEY, {proxy.key: PROXY_INIT_SCORE}, nx=True)
+        queue_attribute_writes(pipe, proxy_list)
+        pipe.zadd(REDIS_PROXY_DUE_KEY, { proxy.key: int(time.time()) + due_delay for proxy in proxy_list }, nx=True)
+        pipe.incr(REDIS_PROXY_VERSION_KEY)
+        return [ proxy for proxy, added in zip(proxy_list, await pipe.execute()) if added == 1 ]
+
+    # 判断代理池中是否存在指定代理
+    async def exist(self, proxy: ProxyItem) -> bool:
+        return await self.redis.zscore(REDIS_PROXY_KEY, proxy.key) is not None
+
+    # 经过验证 proxy 可用 latency connect_latency 为本次验证的耗时 单位秒
+    async def activate(self, proxy: ProxyItem, latency: float = None, connect_latency: float = None) -> bool:
+        return await self.activate_script(keys=PROXY_KEYS, args=activate_args(proxy, int(time.time()), latency, connect_latency)) == 1
 
     # 经过验证 proxy 不可用
-    def deactivate(self, proxy: ProxyItem):
-        if self.exist(proxy):
-            json_repr = json.dumps(proxy.dict())
-            redis_engine.zincrby(REDIS_PROXY_KEY, -1, json_repr)
-
-            score = redis_engine.zscore(REDIS_PROXY_KEY, json_repr)
-            if score <= 0:
-                redis_engine.zrem(REDIS_PROXY_KEY, json_repr)
-            return True
-        else: return False
\ No newline at end of file
+    async def deactivate(self, proxy: ProxyItem) -> bool:
+        return await self.deactivate_script(keys=PROXY_KEYS, args=deactivate_args(proxy, int(time.time()))) == 1
+
+    # 批量写入验证结果 全部脚本调用放在同一个 pipeline 中 一次往返
+    # 参数为 (代理, 是否可用, 验证请求的结果) 列表 返回每个代理是否存在于代理池中
+    async def apply_validate_results(self, results: List[Tuple[ProxyItem, bool, Optional[FetchResult]]]) -> List[bool]:
+        if len(results) == 0: return []
+        checked_at = int(time.time())
+        pipe = self.redis.pipeline(transaction=False)
+        for proxy, is_valid, fetch_result in results:
+            if is_valid:
+                latency, connect_latency = (fetch_result.total_time, fetch_result.connect_time) if fetch_result else (None, None)
+                await self.activate_script(keys=PROXY_KEYS, args=activate_args(proxy, checked_at, latency, connect_latency), client=pipe)
+            else:
+                drop = fetch_result is not None and fetch_result.error in PROXY_DROP_ERRORS
+                await self.deactivate_script(keys=PROXY_KEYS, args=deactivate_args(proxy, checked_at, drop), client=pipe)
+        return [ret == 1 for ret in await pipe.execute()]
+
+    # 创建验证 Stream 以及消费者组 已存在时忽略 shard 见 validate_stream_key
+    async def ensure_validate_group(self, shard: int = None):
+        try:
+            await self.redis.xgroup_create(validate_stream_key(shard), REDIS_VALIDATE_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e): raise
+
+    # 将代理写入验证 Stream 一次往返 返回写入的数量
+    # shard_count 大于 0 时 按 proxy_shard 写入各分片的 Stream
+    async def enqueue_validate(self, proxy_list: List[ProxyItem], shard_count: int = 0) -> int:
+        if len(proxy_list) == 0: return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for proxy in proxy_list:
+            stream_key = validate_stream_key(proxy_shard(proxy.key, shard_count) if shard_count > 0 else None)
+            pipe.xadd(stream_key, {"key": proxy.key, "https": int(proxy.https)})
+        await pipe.execute()
+        return len(proxy_list)
+
+    # 验证 Stream 中积压的消息数量 包括未读取的 以及已读取未确认的
+    async def validate_backlog(self, shard: int = None) -> int:
+        return await self.redis.xlen(validate_stream_key(shard))
+
+    # 以 consumer 读取最多 count 个未分配的消息 返回 (消息 id, 代理) 列表
+    async def read_validate(self, consumer: str, count: int, shard: int = None) -> List[Tuple[str, ProxyItem]]:
+        response = await self.redis.xreadgroup(REDIS_VALIDATE_GROUP, consumer, {validate_stream_key(shard): ">"}, count=count)
+        if not response: return []
+        return to_stream_entries(response[0][1])
+
+    # 将其他消费者读取后超过 min_idle_ms 毫秒未确认的消息 转移给 consumer 验证进程退出时 其中的消息由其他进程继续验证
+    async def reclaim_validate(self, consumer: str, min_idle_ms: int, count: int, shard: int = None) -> List[Tuple[str, ProxyItem]]:
+        response = await self.redis.xautoclaim(
+            validate_stream_key(shard), REDIS_VALIDATE_GROUP, consumer, min_idle_ms, start_id="0-0", count=count
+        )
+        return to_stream_entries(response[1])
+
+    # 确认并写入 Stream 中代理的验证结果 参数为 (消息 id, 代理, 是否可用, 验证请求的结果) 列表
+    # 只写入并统计本次确认成功的结果 同一个消息被转移后验证了两次时 只计入先完成的一次 返回写入的数量
+    async def ack_validate_results(self, results: List[Tuple[str, ProxyItem, bool, Optional[FetchResult]]], shard: int = None) -> int:
+        if len(results) == 0: return 0
+        stream_key, stats_key = validate_stream_key(shard), validate_stats_key(shard)
+        pipe = self.redis.pipeline(transaction=False)
+        for message_id, *_ in results:
+            pipe.xack(stream_key, REDIS_VALIDATE_GROUP, message_id)
+        acked_results = [ result[1:] for result, acked in zip(results, await pipe.execute()) if acked == 1 ]
+        await self.apply_validate_results(acked_results)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xdel(stream_key, *[ message_id for message_id, *_ in results ])
+        if len(acked_results) > 0:
+            pipe.hincrby(stats_key, "total", len(acked_results))
+            pipe.hincrby(stats_key, "activated", sum(1 for _, is_valid, _ in acked_results if is_valid))
+        await pipe.execute()
+        return len(acked_results)
+
+    # 取出并清零验证进程累计的验证数量 返回 (验证数量, 激活数量)
+    async def pop_validate_stats(self, shard: int = None) -> Tuple[int, int]:
+        pipe = self.redis.pipeline()
+        pipe.hgetall(validate_stats_key(shard))
+        pipe.delete(validate_stats_key(shard))
+        stats, _ = await pipe.execute()
+        return int(stats.get("total", 0)), int(stats.get("activated", 0))
+
+    # 将旧版本以 json 字符串为成员的代理 迁移为 ip:port 规范化键 保留原有分数
+    async def migrate_legacy_members(self) -> int:
+        count_of_migrated = 0
+        async for member, score in self.redis.zscan_iter(REDIS_PROXY_KEY, match="{*"):
+            proxy = ProxyItem(**json.loads(member))
+            pipe = self.redis.pipeline()
+            pipe.zadd(REDIS_PROXY_KEY, {proxy.key: score}, gt=True)
+            queue_attribute_writes(pipe, [proxy])
+            pipe.zadd(REDIS_PROXY_DUE_KEY, {proxy.key: int(time.time())}, nx=True)
+            pipe.zrem(REDIS_PROXY_KEY, member)
+            pipe.incr(REDIS_PROXY_VERSION_KEY)
+            await pipe.execute()
+            count_of_migrated += 1
+        return count_of_migrated
+
+    # 将代理池中的代理设置为立即验证 不在代理池中的代理不受影响
+    async def schedule_now(self, proxy_list: List[ProxyItem]):
+        if len(proxy_list) == 0: return
+        await self.redis.zadd(REDIS_PROXY_DUE_KEY, { proxy.key: int(time.time()) for proxy in proxy_list }, xx=True)
+
+    # 旧版本的数据没有属性索引 https 索引均不存在时 以代理已有的属性建立索引 返回建立索引的代理数量
+    async def build_attribute_indexes(self, batch_size: int = 500) -> int:
+        if await self.redis.exists(proxy_index_key("https", 0), proxy_index_key("https", 1)) > 0: return 0
+        count_of_indexed, cursor = 0, 0
+        while True:
+            cursor, proxy_list = await self.get_page(cursor, batch_size)
+            if len(proxy_list) > 0:
+                pipe = self.redis.pipeline()
+                queue_attribute_writes(pipe, proxy_list)
+                await pipe.execute()
+                count_of_indexed += len(proxy_list)
+            if cursor == 0: break
+        return count_of_indexed
+
+    # 为没有下一次验证时间的代理 例如旧版本的数据 设置为立即验证 返回设置的数量
+    async def schedule_unscheduled(self, batch_size: int = 500) -> int:
+        count_of_scheduled, cursor = 0, 0
+        while True:
+            cursor, member_score_list = await self.redis.zscan(REDIS_PROXY_KEY, cursor, count=batch_size)
+            if len(member_score_list) > 0:
+                now = int(time.time())
+                count_of_scheduled += await self.redis.zadd(REDIS_PROXY_DUE_KEY, { key: now for key, _ in member_score_list }, nx=True)
+            if cursor == 0: break
+        return count_of_scheduled